@@ -1,6 +1,9 @@
 import logging
+import threading
+from concurrent.futures import Future
 
 import docker
+from docker.errors import NotFound
 from typing import NamedTuple
 
 import utils
@@ -15,21 +18,73 @@ DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.soc
 class DockerClient:
     def __init__(self, url):
         self.client = docker.DockerClient(base_url=url)
+        self.containers = {}
+
+        # Quota changes that were requested but not applied yet; a newer request for the same container replaces
+        # the older one, and all their futures resolve once the latest value is applied
+        self._pending_updates = {}
+        self._pending_condition = threading.Condition()
+        self._update_thread = None
+
+    def get_container(self, container_ref):
+        container = self.containers.get(container_ref)
+        if container is None:
+            container = self.client.containers.get(container_ref)
+            self.containers[container_ref] = container
+        return container
+
+    def _apply_cpu_quota(self, container_ref, cpus):
+        try:
+            self.get_container(container_ref).update(cpu_quota=cpus * 100000)
+        except NotFound:
+            # Container was recreated under the same name, so the cached handle points to a stale id
+            self.containers.pop(container_ref, None)
+            self.get_container(container_ref).update(cpu_quota=cpus * 100000)
+        logger.info(f"Container set to work with {cpus} cores")
 
-    # TODO: Takes too long with 90ms
     @utils.print_execution_time
     def update_cpu(self, container_ref, cpus):
         try:
-            container = self.client.containers.get(container_ref)
-            container.update(cpu_quota=cpus * 100000)
-            logger.info(f"Container set to work with {cpus} cores")
+            self._apply_cpu_quota(container_ref, cpus)
         except Exception as e:
             logger.error("Could not connect to docker container", e)
 
+    def update_cpu_async(self, container_ref, cpus, callback=None) -> Future:
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+
+        with self._pending_condition:
+            _, futures = self._pending_updates.pop(container_ref, (None, []))
+            self._pending_updates[container_ref] = (cpus, futures + [future])
+            self._pending_condition.notify()
+
+            if self._update_thread is None:
+                self._update_thread = threading.Thread(target=self._process_cpu_updates, daemon=True)
+                self._update_thread.start()
+
+        return future
+
+    def _process_cpu_updates(self):
+        while True:
+            with self._pending_condition:
+                self._pending_condition.wait_for(lambda: len(self._pending_updates) > 0)
+                container_ref = next(iter(self._pending_updates))
+                cpus, futures = self._pending_updates.pop(container_ref)
+
+            try:
+                self._apply_cpu_quota(container_ref, cpus)
+                for future in futures:
+                    future.set_result(cpus)
+            except Exception as e:
+                logger.error(f"Could not update CPU quota of {container_ref}: {e}")
+                for future in futures:
+                    future.set_exception(e)
+
     @utils.print_execution_time
     def get_container_stats(self, container_ref, stream_p=False):
         try:
-            container = self.client.containers.get(container_ref)
+            container = self.get_container(container_ref)
             stats = container.stats(stream=stream_p, decode=stream_p)
             return stats
         except Exception as e:
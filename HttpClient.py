@@ -1,13 +1,25 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+import aiohttp
 import requests
 
+logger = logging.getLogger("multiscale")
+
+PORT = 8080
+
 
 class HttpClient:
     def __init__(self):
-        self.PORT = 8080
+        self.PORT = PORT
         self.SESSION = requests.Session()
         self.http_connection = None
         self.CHANGE_THREADS_ROUTE = "/change_threads"
         self.CHANGE_CONFIG_ROUTE = "/change_config"
+        self.RECONFIGURE_ROUTE = "/reconfigure"
 
         # print(f"Opening HTTP Connection on port {self.PORT}")
 
@@ -19,8 +31,150 @@ class HttpClient:
         response.raise_for_status()  # Raise an exception for non-2xx status codes
 
     def change_config(self, target_route, config):
-        query_params = {"service_description": str(config)}
-        response = self.SESSION.put(f"http://{target_route}:{self.PORT}{self.CHANGE_CONFIG_ROUTE}",
-                                    params=query_params)
+        response = self.SESSION.put(f"http://{target_route}:{self.PORT}{self.CHANGE_CONFIG_ROUTE}", json=config)
         # print(response.content)
         response.raise_for_status()  # Raise an exception for non-2xx status codes
+
+    def reconfigure(self, target_route, pixel=None, cores=None, thread_multiplier=None) -> float:
+        # Changes any subset in one request and one transition on the service; returns its apply latency in ms
+        body = reconfigure_body(pixel, cores, thread_multiplier)
+        response = self.SESSION.put(f"http://{target_route}:{self.PORT}{self.RECONFIGURE_ROUTE}", json=body)
+        response.raise_for_status()
+        return response.json()['apply_ms']
+
+
+def reconfigure_body(pixel=None, cores=None, thread_multiplier=None) -> dict:
+    body = {"pixel": pixel, "cores": cores, "thread_multiplier": thread_multiplier}
+    return {key: int(value) for key, value in body.items() if value is not None}
+
+
+async def read_apply_ms(response):
+    # Only /reconfigure reports an apply latency, the other routes answer with an empty or plain body
+    try:
+        body = await response.json(content_type=None)
+    except ValueError:
+        return None
+    return body.get("apply_ms") if isinstance(body, dict) else None
+
+
+class ControlResult(NamedTuple):
+    target: str
+    latency_s: float
+    error: Exception = None
+    apply_ms: float = None  # Time the service took to apply a /reconfigure, as reported in its response
+
+
+class AsyncHttpClient:
+    """Control client for many services at once; every change is sent concurrently over pooled keep-alive connections.
+
+    Failed requests (connection errors, timeouts, 5xx) are retried with exponential backoff, and every target reports
+    its own latency, so reconfiguring a fleet takes as long as the slowest service instead of the sum of all.
+    """
+
+    def __init__(self, port=PORT, timeout_s=2.0, retries=3, backoff_s=0.1, limit_per_host=4):
+        self.port = port
+        self.timeout = aiohttp.ClientTimeout(total=timeout_s)
+        self.retries = retries
+        self.backoff_s = backoff_s
+        self.limit_per_host = limit_per_host
+        self.session: aiohttp.ClientSession = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily, the session must belong to the event loop that uses it
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    async def put(self, target, route, params=None, json=None) -> ControlResult:
+        # Targets are addresses of services on the default port, or host:port
+        url = f"http://{target}{route}" if ":" in target else f"http://{target}:{self.port}{route}"
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_session().put(url, params=params, json=json) as response:
+                    if response.status < 500:
+                        response.raise_for_status()
+                        elapsed = time.perf_counter() - start
+                        return ControlResult(target, elapsed, apply_ms=await read_apply_ms(response))
+                    error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                        status=response.status)
+            except aiohttp.ClientResponseError as e:
+                if e.status < 500:
+                    return ControlResult(target, time.perf_counter() - start, e)
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff_s * 2 ** attempt)
+
+        logger.warning(f"Giving up on {url} after {self.retries + 1} attempts; {error!r}")
+        return ControlResult(target, time.perf_counter() - start, error)
+
+    async def change_threads(self, target, number) -> ControlResult:
+        return await self.put(target, "/change_threads", {"thread_number": number})
+
+    async def change_config(self, target, config) -> ControlResult:
+        return await self.put(target, "/change_config", json=config)
+
+    async def reconfigure(self, target, pixel=None, cores=None, thread_multiplier=None) -> ControlResult:
+        return await self.put(target, "/reconfigure", json=reconfigure_body(pixel, cores, thread_multiplier))
+
+    async def fan_out(self, requests_by_target: list) -> list[ControlResult]:
+        # requests_by_target: [(target, route, params)], all of them are in flight at the same time
+        return list(await asyncio.gather(*[self.put(target, route, params)
+                                           for target, route, params in requests_by_target]))
+
+    async def reset_all(self, params_by_target: dict) -> list[ControlResult]:
+        # params_by_target: {target: (pixel, cores)}; one reconfiguration per target, all of them concurrently
+        return list(await asyncio.gather(*[self.reconfigure(target, pixel=pixel, cores=cores)
+                                           for target, (pixel, cores) in params_by_target.items()]))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class SyncControlClient:
+    """Blocking facade for AsyncHttpClient; its event loop runs in a daemon thread so connections stay pooled."""
+
+    def __init__(self, **kwargs):
+        self.client = AsyncHttpClient(**kwargs)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def change_threads(self, target, number) -> ControlResult:
+        return self._run(self.client.change_threads(target, number))
+
+    def change_config(self, target, config) -> ControlResult:
+        return self._run(self.client.change_config(target, config))
+
+    def reconfigure(self, target, pixel=None, cores=None, thread_multiplier=None) -> ControlResult:
+        return self._run(self.client.reconfigure(target, pixel, cores, thread_multiplier))
+
+    def fan_out(self, requests_by_target: list) -> list[ControlResult]:
+        return self._run(self.client.fan_out(requests_by_target))
+
+    def reset_all(self, params_by_target: dict) -> list[ControlResult]:
+        return self._run(self.client.reset_all(params_by_target))
+
+    def close(self):
+        self._run(self.client.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+_control_client = None
+_control_client_lock = threading.Lock()
+
+
+def get_control_client() -> SyncControlClient:
+    # Created on first use, so importing an experiment (e.g., in a spawned worker) starts no event loop thread
+    global _control_client
+    with _control_client_lock:
+        if _control_client is None:
+            _control_client = SyncControlClient()
+        return _control_client
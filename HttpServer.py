@@ -1,14 +1,17 @@
-import ast
 import logging
+import threading
+import time
+from typing import Annotated, Optional
 
-from flask import Flask, request
+import uvicorn
+from fastapi import FastAPI, Query
+from fastapi.responses import StreamingResponse
+from prometheus_client import Gauge
+from pydantic import BaseModel, ConfigDict, PositiveInt, model_validator
 
 import utils
 from DockerClient import DockerClient
-from HttpClient import HttpClient
-from QrDetector import QrDetector
-
-app = Flask(__name__)
+from Telemetry import TELEMETRY_ROUTE
 
 # logger = logging.getLogger("multiscale")
 # logging.getLogger('multiscale').setLevel(logging.INFO)
@@ -16,46 +19,138 @@ logging.basicConfig(level=logging.INFO)
 
 DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.sock")
 CONTAINER_REF = utils.get_env_param("CONTAINER_REF", "Unknown")
+PORT = 8080
+
+control_latency = Gauge('control_latency', 'Handling time of the last control request in ms',
+                        ['service_id', 'metric_id'])
+
+
+class ServiceDescription(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    pixel: PositiveInt
+
+
+class Reconfiguration(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    pixel: Optional[PositiveInt] = None
+    cores: Optional[PositiveInt] = None
+    thread_multiplier: Optional[PositiveInt] = None
+
+    @model_validator(mode="after")
+    def not_empty(self):
+        # Explicit nulls count as unset, otherwise the call would be flagged as a change without applying anything
+        if all(v is None for v in (self.pixel, self.cores, self.thread_multiplier)):
+            raise ValueError("Set at least one of pixel, cores and thread_multiplier")
+        return self
+
+
+class ReconfigurationResult(BaseModel):
+    pixel: int
+    cores: int
+    thread_multiplier: int
+    apply_ms: float
+
+
+class TimingMiddleware:
+    """Measures the time from receiving a request to starting its response, i.e., without the network.
+
+    The value is exported per route and returned as Server-Timing header. Plain ASGI instead of Starlette's
+    BaseHTTPMiddleware, which alone would add a few hundred microseconds per request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                handling_ms = (time.perf_counter() - start) * 1000.0
+                message["headers"] = list(message.get("headers", [])) + \
+                    [(b"server-timing", f"app;dur={handling_ms:.3f}".encode())]
+                # Labelled by the matched route, so probes of unknown paths cannot create new series
+                route = scope.get("route")
+                control_latency.labels(service_id="video", metric_id=route.path if route else "other").set(handling_ms)
+            await send(message)
+
+        await self.app(scope, receive, send_with_timing)
 
-http_client = HttpClient()
-qd = QrDetector()
 
-docker_client = DockerClient(DOCKER_SOCKET)
+def create_app(qd, docker_client) -> FastAPI:
+    app = FastAPI()
 
+    app.add_middleware(TimingMiddleware)
 
-# @utils.print_execution_time
-@app.route("/start_video", methods=['POST'])
-def start_video_processing():
-    qd.start_process()
-    return ""
+    # Control handlers only set a few attributes, so they run on the event loop instead of a worker thread
+    @app.post("/start_video")
+    async def start_video_processing():
+        qd.start_process()
+        return {}
 
+    @app.post("/stop_all")
+    async def terminate_processing():
+        qd.terminate()
+        return {}
 
-@app.route("/stop_all", methods=['POST'])
-def terminate_processing():
-    qd.terminate()
-    return ""
+    @app.put("/change_config")
+    async def change_config(service_d: ServiceDescription):
+        qd.change_config(service_d.model_dump())
+        return {}
 
+    @app.put("/change_threads")
+    async def change_threads(thread_number: Annotated[int, Query(gt=0)]):
+        # Change the number of threads of the application
+        qd.change_threads(thread_number)
+        # Change the number of cores available for docker, applied in the background so the request returns directly
+        docker_client.update_cpu_async(CONTAINER_REF, thread_number)
+        return {}
 
-@app.route("/change_config", methods=['PUT'])
-def change_config():
-    service_d = ast.literal_eval(request.args.get('service_description'))
-    qd.change_config(service_d)
+    @app.put("/reconfigure")
+    async def reconfigure(reconfiguration: Reconfiguration) -> ReconfigurationResult:
+        # Any subset of pixel, cores and thread_multiplier, applied as a single transition
+        apply_ms = qd.reconfigure(**reconfiguration.model_dump(exclude_unset=True))
+        if reconfiguration.cores is not None:
+            docker_client.update_cpu_async(CONTAINER_REF, reconfiguration.cores)
 
-    return ""
+        return ReconfigurationResult(pixel=qd.service_conf['pixel'], cores=qd.cores,
+                                     thread_multiplier=qd.thread_multiplier, apply_ms=apply_ms)
 
+    @app.get(TELEMETRY_ROUTE)
+    def stream_telemetry():
+        # One sample per report interval as server-sent events; the blocking generator is iterated in a worker thread
+        return StreamingResponse(qd.telemetry.stream_events(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
 
-@app.route("/change_threads", methods=['PUT'])
-def change_threads():
-    threads_num = int(request.args.get('thread_number'))
+    return app
 
-    # Change the number of threads of the application
-    qd.change_threads(threads_num)
-    # Change the number of cores available for docker
-    docker_client.update_cpu(CONTAINER_REF, threads_num)
 
-    return ""
+def start_control_server(app: FastAPI, host='0.0.0.0', port=PORT) -> uvicorn.Server:
+    # The event loop gets its own thread, so control requests never queue behind the frame processing loop
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", access_log=False))
+    thread = threading.Thread(target=server.run, name="control-server", daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError(f"Control server could not start on {host}:{port}")
+        time.sleep(0.01)
+    return server
 
 
 if __name__ == '__main__':
-    start_video_processing()
-    app.run(host='0.0.0.0', port=8080)
+    # Imported here, so create_app can be used without video, pyzbar or Docker
+    from QrDetector import QrDetector
+
+    detector = QrDetector()
+    detector.start_process()
+    control_server = start_control_server(create_app(detector, DockerClient(DOCKER_SOCKET)))
+
+    try:
+        while True:
+            time.sleep(1000)
+    finally:
+        control_server.should_exit = True
+        detector.shutdown()
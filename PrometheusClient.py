@@ -1,8 +1,21 @@
+import logging
+import math
+import re
+import threading
+import time
+from collections import deque
+
 from prometheus_api_client import PrometheusConnect
 
 import utils
 from slo_config import MB
 
+logger = logging.getLogger("multiscale")
+
+POLL_INTERVAL = float(utils.get_env_param('POLL_INTERVAL', 1.0))
+LOOKBACK_S = 60  # Longest period that agents can average over
+EXPORTER_PORT = 8000
+
 
 class PrometheusClient:
     def __init__(self, url):
@@ -19,6 +32,104 @@ class PrometheusClient:
         transformed = utils.convert_prom_multi(metric_data, item_name="metric_id", decimal=True)
         return transformed
 
+    def get_samples(self, metric_name, instances, window_s):
+        # Raw samples of the last window_s seconds for all instances in a single query
+        instance_regex = "|".join(re.escape(f"{instance}:{EXPORTER_PORT}") for instance in instances)
+        return self.client.custom_query(query=f'{{__name__=~"{metric_name}",instance=~"{instance_regex}"}}'
+                                              f'[{int(math.ceil(window_s))}s]')
+
+
+class MetricsPoller(threading.Thread):
+    """Fetches the metrics of all registered instances with one query per interval and caches the raw samples.
+
+    Agents read their own instance from the cache through get_metrics, which mirrors PrometheusClient.get_metrics
+    but averages the period locally; age() tells how old the cache is instead of retrying until data arrives.
+    """
+
+    def __init__(self, prom_client: PrometheusClient, metric_names=tuple(MB['variables']), interval=POLL_INTERVAL,
+                 lookback_s=LOOKBACK_S):
+        super().__init__(daemon=True)
+        self.prom_client = prom_client
+        self.metric_name = "|".join(metric_names)
+        self.interval = interval
+        self.lookback_s = lookback_s
+
+        self.instances = set()
+        self.polled_instances = set()
+        self.samples = {}  # (instance, metric name, metric_id) -> deque of (timestamp in s, value)
+        self.last_update = None  # Monotonic time of the last successful poll
+        self._condition = threading.Condition()
+        self._running = True
+
+    def register(self, instance):
+        with self._condition:
+            self.instances.add(instance)
+
+    def run(self):
+        while self._running:
+            try:
+                self.poll()
+            except Exception as e:
+                logger.warning(f"Polling Prometheus failed, metrics are {self.age():.1f}s old; {e!r}")
+            time.sleep(self.interval)
+
+    def stop(self):
+        self._running = False
+
+    def poll(self):
+        with self._condition:
+            instances = set(self.instances)
+        if not instances:
+            return
+
+        # Once every instance got its full lookback, only the samples since the previous poll (plus slack) are fetched
+        window_s = self.lookback_s
+        if instances == self.polled_instances:
+            window_s = min(self.lookback_s, time.monotonic() - self.last_update + 2 * self.interval)
+        result = self.prom_client.get_samples(self.metric_name, sorted(instances), window_s)
+
+        with self._condition:
+            for series in result:
+                labels = series['metric']
+                key = (labels['instance'].rsplit(":", 1)[0], labels['__name__'], labels['metric_id'])
+                samples = self.samples.setdefault(key, deque())
+                last_timestamp = samples[-1][0] if samples else -math.inf
+                samples.extend((float(ts), float(value)) for ts, value in series['values']
+                               if float(ts) > last_timestamp)
+
+                while samples and samples[0][0] < samples[-1][0] - self.lookback_s:
+                    samples.popleft()
+
+            self.polled_instances = instances
+            self.last_update = time.monotonic()
+            self._condition.notify_all()
+
+    def age(self) -> float:
+        return math.inf if self.last_update is None else time.monotonic() - self.last_update
+
+    def wait_for_update(self, timeout=None) -> bool:
+        with self._condition:
+            last_update = self.last_update
+            return self._condition.wait_for(lambda: self.last_update != last_update, timeout)
+
+    def get_metrics(self, metric_name, period=None, instance=None):
+        # Average over the last period seconds, or the latest value without a period, like avg_over_time would
+        pattern = re.compile(metric_name)
+        period_s = float(period.rstrip("s")) if isinstance(period, str) else period
+        metrics = {}
+
+        with self._condition:
+            for (sample_instance, name, metric_id), samples in self.samples.items():
+                if sample_instance != instance or not samples or not pattern.fullmatch(name):
+                    continue
+                if period_s is None:
+                    metrics[metric_id] = samples[-1][1]
+                else:
+                    newest = samples[-1][0]
+                    values = [value for ts, value in samples if ts >= newest - period_s]
+                    metrics[metric_id] = sum(values) / len(values)
+        return metrics
+
 
 if __name__ == "__main__":
     client = PrometheusClient("http://172.18.0.2:9090")
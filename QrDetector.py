@@ -1,148 +1,250 @@
 import concurrent.futures
 import datetime
 import logging
+import multiprocessing
 import threading
 import time
 
-import cv2
 from prometheus_client import start_http_server, Gauge
-from pyzbar.pyzbar import decode
 
+import QrWorker
 import utils
 from DockerClient import DockerClient
+from StatsCollector import CpuStatsCollector
+from Telemetry import TelemetryHub
+from slo_config import PW_MAX_CORES
 from VehicleService import VehicleService
 from VideoReader import VideoReader
 
 DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.sock")
 CONTAINER_REF = utils.get_env_param("CONTAINER_REF", "Unknown")
+EXECUTOR_BACKEND = utils.get_env_param("EXECUTOR_BACKEND", "thread")  # "thread" or "process"
+REPORT_INTERVAL = 0.25  # Seconds between two gauge updates / metric rows
+STAGE_SMOOTHING = 0.05  # Weight of the newest frame in the per-stage averages
+METRICS_FILE = "./share/metrics/LGBN.csv"
+METRICS_HEADER = ["timestamp", "fps", "pixel", "cores", "energy", "change_flag"]
 
 logger = logging.getLogger("multiscale")
 
-start_http_server(8000)
 fps = Gauge('fps', 'Current processing FPS', ['service_id', 'metric_id'])
 pixel = Gauge('pixel', 'Current configured pixel', ['service_id', 'metric_id'])
 energy = Gauge('energy', 'Current processing energy', ['service_id', 'metric_id'])
 cores = Gauge('cores', 'Current configured cores', ['service_id', 'metric_id'])
-
-docker_stats = None
+resize_latency = Gauge('resize_latency', 'Latency of the last thread resize in ms', ['service_id', 'metric_id'])
+stage_latency = Gauge('stage_latency', 'Average time per frame and processing stage in ms', ['service_id', 'metric_id'])
 
 
 class QrDetector(VehicleService):
     def __init__(self):
         super().__init__()
+        # Started here instead of on import, spawned decoding workers import the main module again
+        start_http_server(8000)
         self._terminated = True
         self._running = False
         self.service_conf = {'pixel': 800}
         self.cores = 2
         self.thread_multiplier = 4
         self.number_threads = self.cores * self.thread_multiplier
+        self.max_threads = PW_MAX_CORES * self.thread_multiplier
+        self.resize_started = None
+        self._loop_active = False  # While set, only the processing loop finishes resizes
+        self.backend = EXECUTOR_BACKEND
+        self.frame_arena = None
+        self.processing_thread = None
         self.fps = utils.FPS_()
+        self.stage_ms = dict.fromkeys(QrWorker.STAGES, 0.0)
 
         self.webcam_stream = VideoReader()
+        self.webcam_stream.select_pixel(self.service_conf['pixel'])
         self.webcam_stream.start()
         self.flag_next_metrics = False
+        self._flag_lock = threading.Lock()
+        self._stop_event = threading.Event()
         self.docker_client = DockerClient(DOCKER_SOCKET)
-
-        # TOD: Ideally, this is not part of the service; after all, it can run alone monitoring and providing
-        # self.stats_stream = self.docker_client.get_container_stats(CONTAINER_REF, stream_p=True)
-        # threading.Thread(target=resolve_docker_load, args=(self.stats_stream,), daemon=True).start()
-
-    def process_one_iteration(self, config_params, frame) -> None:
-
-        target_height = int(config_params['pixel'])
-
-        original_width, original_height = frame.shape[1], frame.shape[0]
-        ratio = original_height / target_height
-        frame = cv2.resize(frame, (int(original_width / ratio), int(original_height / ratio)))
-
-        start_time = time.time()
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        decoded_objects = decode(gray)
-
-        # Resulting image and total processing time --> unused
-        combined_img = utils.highlight_qr_codes(frame, decoded_objects)
-        processing_time = (time.time() - start_time) * 1000.0
+        self.stats_collector = CpuStatsCollector(self.docker_client, CONTAINER_REF)
+        self.stats_collector.start()
+        self.telemetry = TelemetryHub()
+        threading.Thread(target=self.report_loop, daemon=True).start()
+
+    def process_one_iteration(self, config_params, frame) -> tuple:
+        return QrWorker.decode_frame(frame, config_params)
+
+    # The pool is sized for the maximum allocation once; number_threads only gates how many frames are in flight
+    def create_executor(self):
+        if self.backend == "thread":
+            return concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads)
+        elif self.backend == "process":
+            # Frames are copied into shared memory slots, so only the slot index and shape are sent to the workers;
+            # the slots fit the full-resolution frames, pre-scaled ones are smaller
+            self.frame_arena = QrWorker.SharedFrameArena(self.max_threads, self.webcam_stream.frame_shape)
+            # Spawned instead of forked, forking while the reader and report threads run can deadlock the workers
+            return concurrent.futures.ProcessPoolExecutor(max_workers=PW_MAX_CORES,
+                                                          mp_context=multiprocessing.get_context("spawn"),
+                                                          initializer=QrWorker.attach_arena,
+                                                          initargs=self.frame_arena.descriptor())
+        raise ValueError(f"Unknown executor backend '{self.backend}'")
+
+    def submit_frame(self, executor, frame):
+        if self.frame_arena is None:
+            return executor.submit(self.process_one_iteration, self.service_conf, frame)
+
+        arena = self.frame_arena
+        slot = arena.put(frame)
+        future = executor.submit(QrWorker.decode_arena_slot, slot, frame.shape, self.service_conf)
+        future.add_done_callback(lambda _: arena.release(slot))
+        return future
 
     def process_loop(self):
-        metric_buffer = []
+        in_flight = set()
 
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.number_threads) as executor:
+        executor = self.create_executor()
+        try:
             while self._running:
 
-                buffer = self.webcam_stream.get_buffer_size_n(self.number_threads)
-                future_dict = {executor.submit(self.process_one_iteration, self.service_conf, frame): frame
-                               for frame in buffer}
+                # Refill every free worker slot right away instead of waiting for a whole batch to finish
+                while len(in_flight) < self.number_threads and self._running:
+                    frame = self.webcam_stream.read(timeout=1.0)
+                    if frame is None:
+                        break
+                    in_flight.add(self.submit_frame(executor, frame))
+
+                if self.resize_started is not None and len(in_flight) <= self.number_threads:
+                    self.finish_resize()
+
+                if not in_flight:
+                    continue
 
-                for future in concurrent.futures.as_completed(future_dict):
-                    number = future_dict[future]
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
                     try:
-                        result = future.result()  # Does not even return anything!
+                        self.record_stages(future.result())
                         self.fps.tick()
                     except Exception as e:
-                        print(f"Error occurred while fetching {number}: {e}")
-
-                # This is only executed once, and not for every frame
-                processing_fps = self.fps.get_current_fps()
-                fps.labels(service_id="video", metric_id="fps").set(processing_fps)
-                pixel.labels(service_id="video", metric_id="pixel").set(self.service_conf['pixel'])
-                cores.labels(service_id="video", metric_id="cores").set(self.cores)
-
-                cpu_load = 0
-                # try:
-                #     cpu_load = utils.calculate_cpu_percentage(docker_stats)
-                # except KeyError as e:
-                #     logger.warning(f"Cannot get CPU load, setting to 0 for now; {e.args}")
-                #     cpu_load = 0
-                energy.labels(service_id="video", metric_id="energy").set(cpu_load)
-
-                metric_buffer.append((datetime.datetime.now(), processing_fps, self.service_conf['pixel'], self.cores,
-                                      cpu_load, self.flag_next_metrics))
-                self.flag_next_metrics = False
-                if len(metric_buffer) >= 15:
-                    utils.write_metrics_to_csv(metric_buffer)
-                    metric_buffer.clear()
+                        print(f"Error occurred while processing frame: {e}")
+        finally:
+            # Workers detach from the arena when they exit, so it is only closed and unlinked once all of them are gone
+            executor.shutdown(wait=True)
+            if self.frame_arena is not None:
+                self.frame_arena.close()
+                self.frame_arena = None
+            self._loop_active = False
+            self.finish_resize()
 
         self._terminated = True
         logger.info("QR Detector stopped")
 
+    def record_stages(self, stage_times):
+        for stage, ms in zip(QrWorker.STAGES, stage_times):
+            self.stage_ms[stage] += STAGE_SMOOTHING * (ms - self.stage_ms[stage])
+
+    def report_loop(self):
+        metrics_writer = utils.get_metrics_writer(METRICS_FILE, METRICS_HEADER)
+
+        while not self._stop_event.wait(REPORT_INTERVAL):
+            if not self._running:
+                continue
+
+            processing_fps = self.fps.get_current_fps()
+            fps.labels(service_id="video", metric_id="fps").set(processing_fps)
+            fps.labels(service_id="video", metric_id="fps_5s").set(self.fps.get_fps(5))
+            fps.labels(service_id="video", metric_id="fps_ewma").set(self.fps.get_ewma_fps())
+            pixel.labels(service_id="video", metric_id="pixel").set(self.service_conf['pixel'])
+            cores.labels(service_id="video", metric_id="cores").set(self.cores)
+            for stage, ms in self.stage_ms.items():
+                stage_latency.labels(service_id="video", metric_id=stage).set(ms)
+
+            cpu_load = self.stats_collector.get_cpu_load()
+            energy.labels(service_id="video", metric_id="energy").set(cpu_load)
+
+            # Read and reset together, a change flagged in between would otherwise never reach a row
+            with self._flag_lock:
+                change_flag, self.flag_next_metrics = self.flag_next_metrics, False
+
+            metrics_writer.write((datetime.datetime.now(), processing_fps, self.service_conf['pixel'], self.cores,
+                                  cpu_load, change_flag))
+            self.telemetry.publish({"timestamp": time.time(), "fps": processing_fps,
+                                    "pixel": self.service_conf['pixel'], "cores": self.cores, "energy": cpu_load})
+
     def start_process(self):
         self._terminated = False
         self._running = True
+        self._loop_active = True
 
-        processing_thread = threading.Thread(target=self.process_loop, daemon=True)
-        processing_thread.start()
+        self.processing_thread = threading.Thread(target=self.process_loop, daemon=True)
+        self.processing_thread.start()
         logger.info("QR Detector started")
 
     def terminate(self):
         self._running = False
 
+    def shutdown(self):
+        # Unlike terminate, which only pauses processing, this also ends the report loop and the video reader
+        self.terminate()
+        if self.processing_thread is not None:
+            self.processing_thread.join()
+        self._stop_event.set()
+        self.webcam_stream.stop()
+
+    def flag_change(self):
+        with self._flag_lock:
+            self.flag_next_metrics = True
+
     def change_config(self, config):
         self.service_conf = config
-        self.flag_next_metrics = True
+        self.webcam_stream.select_pixel(config['pixel'])
+        self.flag_change()
         logger.info(f"QR Detector changed to {config}")
 
-    # TODO: Takes too long with 106ms
-    @utils.print_execution_time
     def change_threads(self, c_threads):
-        self.terminate()
-        # Wait until it is really terminated and then start new
-        while not self._terminated:
-            time.sleep(0.01)
-
+        # The running loop picks up the new limit on its next refill; shrinking lets surplus frames finish
+        self.resize_started = time.perf_counter()
         self.cores = c_threads
+        self.number_threads = min(self.cores * self.thread_multiplier, self.max_threads)
         logger.info(f"QR Detector set to {c_threads} threads")
-        self.start_process()
-
 
-def resolve_docker_load(stream_object):
-    global docker_stats
-    for stats in stream_object:
-        docker_stats = stats
+        if not self._loop_active:
+            self.finish_resize()
+
+    def reconfigure(self, pixel=None, cores=None, thread_multiplier=None) -> float:
+        # Applies any subset of the parameters as one transition, so the metrics are flagged once; returns ms
+        start = time.perf_counter()
+        if pixel is not None:
+            self.service_conf = self.service_conf | {'pixel': int(pixel)}
+            self.webcam_stream.select_pixel(pixel)
+        if thread_multiplier is not None:
+            self.thread_multiplier = int(thread_multiplier)
+        if cores is not None or thread_multiplier is not None:
+            self.resize_started = start
+            self.cores = int(cores) if cores is not None else self.cores
+            # The pool was sized for the initial multiplier, a larger one is capped at max_threads
+            self.number_threads = min(self.cores * self.thread_multiplier, self.max_threads)
+            if not self._loop_active:
+                self.finish_resize()
+
+        self.flag_change()
+        latency_ms = (time.perf_counter() - start) * 1000.0
+        logger.info(f"QR Detector reconfigured to {self.service_conf, self.cores, self.thread_multiplier} "
+                    f"in {latency_ms:.3f} ms")
+        return latency_ms
+
+    def finish_resize(self):
+        # Taken under the lock, a resize that the loop and a request both see pending is only finished once
+        with self._flag_lock:
+            started, self.resize_started = self.resize_started, None
+        if started is None:
+            return
+
+        latency_ms = (time.perf_counter() - started) * 1000.0
+        resize_latency.labels(service_id="video", metric_id="resize_latency").set(latency_ms)
+        logger.info(f"QR Detector resized to {self.number_threads} threads in {latency_ms:.1f} ms")
 
 
 if __name__ == '__main__':
     qd = QrDetector()
     qd.start_process()
 
-    while True:
-        time.sleep(1000)
+    try:
+        while True:
+            time.sleep(1000)
+    finally:
+        qd.shutdown()
@@ -0,0 +1,143 @@
+import functools
+import queue
+import threading
+import time
+from multiprocessing import shared_memory, util
+
+import cv2
+import numpy as np
+from pyzbar.pyzbar import decode
+
+import utils
+
+ANNOTATE_FRAMES = utils.get_env_param("ANNOTATE_FRAMES", "False") == "True"
+STAGES = ("convert", "resize", "decode", "annotate")
+GRAY_FIRST_MIN_SCALE = 0.4  # Below this height ratio, resizing the color frame first is faster than converting first
+
+# Set in every pool process by attach_arena, so frames never have to be pickled
+_arena_frames = None
+_arena_shm = None
+
+# Destination buffers of every worker thread (or process), reused as long as the frame and target size stay the same
+_buffers = threading.local()
+
+
+def _get_buffer(name, shape):
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = np.empty(shape, dtype=np.uint8)
+        setattr(_buffers, name, buffer)
+    return buffer
+
+
+@functools.lru_cache(maxsize=64)
+def target_size(original_width, original_height, target_height):
+    ratio = original_height / target_height
+    return int(original_width / ratio), int(original_height / ratio)
+
+
+def decode_frame(frame, config_params, annotate=ANNOTATE_FRAMES) -> tuple:
+    """Decodes the QR codes of one frame and returns the time of each stage in STAGES in ms."""
+    start = time.perf_counter()
+    original_height, original_width = frame.shape[0], frame.shape[1]
+    target_height = int(config_params['pixel'])
+    width, height = target_size(original_width, original_height, target_height)
+
+    if original_height == target_height:
+        # Frames pre-scaled by the frame cache already have the configured height, only the conversion is left
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=_get_buffer("resized", (original_height, original_width)))
+        prepared = time.perf_counter()
+        convert_ms, resize_ms = prepared - start, 0.0
+    elif height >= original_height * GRAY_FIRST_MIN_SCALE:
+        # Grayscale first, so that the resize only touches a third of the bytes
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=_get_buffer("gray", (original_height, original_width)))
+        converted = time.perf_counter()
+        gray = cv2.resize(gray, (width, height), dst=_get_buffer("resized", (height, width)))
+        prepared = time.perf_counter()
+        convert_ms, resize_ms = converted - start, prepared - converted
+    else:
+        # Strong downscales are cheaper the other way round, converting the full frame would dominate
+        small = cv2.resize(frame, (width, height), dst=_get_buffer("resized_color", (height, width, 3)))
+        resized = time.perf_counter()
+        gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY, dst=_get_buffer("resized", (height, width)))
+        prepared = time.perf_counter()
+        convert_ms, resize_ms = prepared - resized, resized - start
+
+    decoded_objects = decode(gray)
+    decoded = time.perf_counter()
+
+    if annotate:
+        # Resulting image --> unused, only drawn when explicitly requested
+        utils.highlight_qr_codes(cv2.resize(frame, (width, height)), decoded_objects)
+    annotated = time.perf_counter()
+
+    return convert_ms * 1000.0, resize_ms * 1000.0, (decoded - prepared) * 1000.0, (annotated - decoded) * 1000.0
+
+
+class SharedFrameArena:
+    """Pre-allocated frame slots in shared memory that are handed to a process pool by index.
+
+    Slots are sized for frames of the given shape; smaller frames, e.g., pre-scaled ones, use the start of a slot.
+    """
+
+    def __init__(self, slots, shape, dtype=np.uint8):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        size = slots * int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.frames = np.ndarray((slots, int(np.prod(self.shape))), dtype=self.dtype, buffer=self.shm.buf)
+
+        self._free_slots = queue.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+
+    def descriptor(self):
+        return self.shm.name, self.slots, self.shape, self.dtype.str
+
+    def put(self, frame) -> int:
+        if frame.size > self.frames.shape[1]:
+            raise ValueError(f"Frame of shape {frame.shape} does not fit arena slots of shape {self.shape}")
+
+        slot = self._free_slots.get()  # Blocks until a worker released its slot
+        np.copyto(slot_view(self.frames, slot, frame.shape), frame)
+        return slot
+
+    def release(self, slot):
+        self._free_slots.put(slot)
+
+    def close(self):
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+
+def slot_view(frames, slot, shape):
+    # Contiguous view of the first bytes of a slot
+    return frames[slot, :int(np.prod(shape))].reshape(shape)
+
+
+def attach_arena(name, slots, shape, dtype):
+    global _arena_frames, _arena_shm
+    try:
+        # The parent owns the segment, a worker must not be tracked as owner (Python >= 3.13)
+        _arena_shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Older versions always register it; spawned workers share the parent's tracker, which already holds the name
+        _arena_shm = shared_memory.SharedMemory(name=name)
+    _arena_frames = np.ndarray((slots, int(np.prod(shape))), dtype=np.dtype(dtype), buffer=_arena_shm.buf)
+    # Pool workers skip atexit, but run multiprocessing finalizers when they exit
+    util.Finalize(None, detach_arena, exitpriority=10)
+
+
+def detach_arena():
+    global _arena_frames, _arena_shm
+    _arena_frames = None
+    if _arena_shm is not None:
+        _arena_shm.close()
+        _arena_shm = None
+
+
+def decode_arena_slot(slot, shape, config_params) -> tuple:
+    return decode_frame(slot_view(_arena_frames, slot, shape), config_params)
@@ -0,0 +1,83 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("multiscale")
+
+CGROUP_V2_STAT = "/sys/fs/cgroup/cpu.stat"
+CGROUP_V1_USAGE = "/sys/fs/cgroup/cpuacct/cpuacct.usage"
+
+
+def read_cgroup_usage_ns():
+    if os.path.isfile(CGROUP_V2_STAT):
+        with open(CGROUP_V2_STAT) as file:
+            for line in file:
+                key, value = line.split()
+                if key == "usage_usec":
+                    return int(value) * 1000
+    elif os.path.isfile(CGROUP_V1_USAGE):
+        with open(CGROUP_V1_USAGE) as file:
+            return int(file.read())
+    return None
+
+
+class CpuStatsCollector:
+    """Tracks the CPU utilisation of the own container over a sliding window.
+
+    Reads the cumulative usage counter from the cgroup filesystem, which is a single file read per sample; if no
+    cgroup is mounted it falls back to consuming the Docker stats stream. 100 corresponds to one fully used core.
+    """
+
+    def __init__(self, docker_client=None, container_ref=None, window=2.0, interval=0.25):
+        self.docker_client = docker_client
+        self.container_ref = container_ref
+        self.window = window
+        self.interval = interval
+        self.samples = deque()  # (monotonic time in s, cumulative CPU usage in ns)
+        self._lock = threading.Lock()
+
+    def start(self):
+        if read_cgroup_usage_ns() is not None:
+            target = self.poll_cgroup
+        elif self.docker_client is not None:
+            target = self.consume_docker_stream
+        else:
+            logger.warning("Neither cgroup stats nor Docker available, CPU load stays at 0")
+            return
+
+        threading.Thread(target=target, daemon=True).start()
+
+    def poll_cgroup(self):
+        while True:
+            self.add_sample(time.monotonic(), read_cgroup_usage_ns())
+            time.sleep(self.interval)
+
+    def consume_docker_stream(self):
+        stream = self.docker_client.get_container_stats(self.container_ref, stream_p=True)
+        if stream is None:
+            return
+
+        for stats in stream:
+            try:
+                self.add_sample(time.monotonic(), stats['cpu_stats']['cpu_usage']['total_usage'])
+            except KeyError as e:
+                logger.warning(f"Incomplete Docker stats, skipping sample; {e.args}")
+
+    def add_sample(self, timestamp, usage_ns):
+        with self._lock:
+            self.samples.append((timestamp, usage_ns))
+            # Keep one sample older than the window so the delta always spans the full window
+            while len(self.samples) > 2 and timestamp - self.samples[1][0] >= self.window:
+                self.samples.popleft()
+
+    def get_cpu_load(self) -> int:
+        with self._lock:
+            if len(self.samples) < 2:
+                return 0
+            (t_first, u_first), (t_last, u_last) = self.samples[0], self.samples[-1]
+
+        if t_last <= t_first:
+            return 0
+        return int((u_last - u_first) / ((t_last - t_first) * 1e9) * 100)
@@ -0,0 +1,128 @@
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+import requests
+
+logger = logging.getLogger("multiscale")
+
+TELEMETRY_ROUTE = "/telemetry"
+SUBSCRIBER_QUEUE = 64  # Samples buffered per subscriber before the oldest are dropped
+LOOKBACK_S = 60
+MAX_AGE_S = 2.0  # Older telemetry counts as unavailable
+
+
+class TelemetryHub:
+    """Fans the samples of the report loop out to any number of subscribers, each with its own bounded queue.
+
+    Publishing never blocks; a subscriber that does not keep up loses its oldest samples.
+    """
+
+    def __init__(self, max_queue=SUBSCRIBER_QUEUE):
+        self.max_queue = max_queue
+        self.subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self) -> queue.Queue:
+        subscriber = queue.Queue(maxsize=self.max_queue)
+        with self._lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, sample: dict):
+        with self._lock:
+            subscribers = list(self.subscribers)
+
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(sample)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def stream_events(self, heartbeat_s=5.0):
+        # Server-sent events; a comment line as heartbeat lets a dead client be noticed while the service is idle
+        subscriber = self.subscribe()
+        try:
+            while True:
+                try:
+                    yield f"data: {json.dumps(subscriber.get(timeout=heartbeat_s))}\n\n"
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class TelemetrySubscriber(threading.Thread):
+    """Reads the telemetry stream of one service into a rolling window and reconnects with backoff if it breaks.
+
+    get_metrics mirrors PrometheusClient.get_metrics, so agents can use it while is_live() and fall back otherwise.
+    """
+
+    def __init__(self, target, port=8080, lookback_s=LOOKBACK_S, max_age_s=MAX_AGE_S):
+        super().__init__(daemon=True)
+        self.url = f"http://{target}:{port}{TELEMETRY_ROUTE}"
+        self.lookback_s = lookback_s
+        self.max_age_s = max_age_s
+
+        self.samples = deque()  # (timestamp in s, sample)
+        self.last_received = None  # Monotonic time of the newest sample
+        self._lock = threading.Lock()
+        self._running = True
+
+    def run(self):
+        backoff = 0.5
+        while self._running:
+            try:
+                with requests.get(self.url, stream=True, timeout=(2.0, 10.0)) as response:
+                    response.raise_for_status()
+                    backoff = 0.5
+                    for line in response.iter_lines(decode_unicode=True):
+                        if not self._running:
+                            return
+                        if line and line.startswith("data: "):
+                            self.add_sample(json.loads(line[len("data: "):]))
+            except (requests.RequestException, ValueError) as e:
+                logger.warning(f"Telemetry stream {self.url} unavailable, retrying in {backoff}s; {e!r}")
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 10.0)
+
+    def stop(self):
+        self._running = False
+
+    def add_sample(self, sample: dict):
+        with self._lock:
+            self.samples.append((sample['timestamp'], sample))
+            while self.samples[0][0] < sample['timestamp'] - self.lookback_s:
+                self.samples.popleft()
+            self.last_received = time.monotonic()
+
+    def is_live(self) -> bool:
+        return self.last_received is not None and time.monotonic() - self.last_received <= self.max_age_s
+
+    def get_metrics(self, metric_name, period=None, instance=None):
+        # Average over the last period seconds, or the newest value without a period; instance is implied
+        names = metric_name.split("|")
+        period_s = float(period.rstrip("s")) if isinstance(period, str) else period
+
+        with self._lock:
+            if not self.samples:
+                return {}
+            newest = self.samples[-1][0]
+            window = [sample for ts, sample in self.samples if period_s is None or ts >= newest - period_s]
+        if period_s is None:
+            window = window[-1:]
+
+        return {name: sum(sample[name] for sample in window) / len(window) for name in names if name in window[-1]}
@@ -1,13 +1,144 @@
-
 import os
-import cv2
+import tempfile
+import threading
+from collections import deque
 from threading import Thread
+from typing import NamedTuple
+
+import cv2
+import numpy as np
 
 import utils
 
+FRAME_BUFFER_SIZE = int(utils.get_env_param('FRAME_BUFFER_SIZE', 16))
+FRAME_BACKPRESSURE = utils.get_env_param('FRAME_BACKPRESSURE', "block")  # "block" or "drop_oldest"
+FRAME_CACHE = utils.get_env_param('FRAME_CACHE', "False") == "True"
+FRAME_CACHE_DIR = utils.get_env_param('FRAME_CACHE_DIR', tempfile.gettempdir())
+FRAME_CACHE_PIXEL = int(utils.get_env_param('FRAME_CACHE_PIXEL', 0))  # Height of pre-scaled cached frames, 0 for none
+
+
+class Frame(NamedTuple):
+    seq: int
+    image: np.ndarray
+
+
+class FrameBuffer:
+    """Bounded producer/consumer queue of decoded frames.
+
+    With "block" the producer waits until a consumer frees a slot; with "drop_oldest" the oldest queued frame is
+    discarded instead, which is what a live camera would do.
+    """
+
+    def __init__(self, capacity, backpressure="block"):
+        if backpressure not in ("block", "drop_oldest"):
+            raise ValueError(f"Unknown backpressure policy '{backpressure}'")
+
+        self.capacity = capacity
+        self.backpressure = backpressure
+        self.dropped = 0
+        self._frames = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+
+    def put(self, frame: Frame) -> bool:
+        with self._lock:
+            if self.backpressure == "block":
+                while len(self._frames) >= self.capacity and not self._closed:
+                    self._not_full.wait()
+            elif len(self._frames) >= self.capacity:
+                self._frames.popleft()
+                self.dropped += 1
+
+            if self._closed:
+                return False
+
+            self._frames.append(frame)
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout=None) -> Frame | None:
+        with self._lock:
+            if not self._not_empty.wait_for(lambda: self._frames or self._closed, timeout):
+                return None
+            if not self._frames:
+                return None
+
+            frame = self._frames.popleft()
+            self._not_full.notify()
+            return frame
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+    def __len__(self):
+        return len(self._frames)
+
+
+class FrameCache:
+    """Raw frames of one pass over the video in a flat memory-mapped file, served as zero-copy views afterwards.
+
+    The first pass writes into a temporary file that is only renamed once it is complete, so an interrupted run never
+    leaves a truncated cache behind; later runs with the same video and frame size skip decoding altogether.
+    """
+
+    def __init__(self, video_path, shape, max_frames, cache_dir=FRAME_CACHE_DIR):
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        # The modification time is part of the name, so a replaced video never gets the frames of its predecessor
+        version = int(os.path.getmtime(video_path))
+        self.path = os.path.join(cache_dir, f"{name}_{version}_{shape[1]}x{shape[0]}.frames")
+        self.shape = tuple(shape)
+        self.frame_bytes = int(np.prod(self.shape))
+        self.count = 0
+        self._part_path = None
+
+        if os.path.exists(self.path):
+            self.frames = self._open()
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, self._part_path = tempfile.mkstemp(suffix=".part", dir=cache_dir)
+            os.close(fd)
+            self.frames = np.memmap(self._part_path, dtype=np.uint8, mode="w+", shape=(max_frames, *self.shape))
+
+    @property
+    def complete(self) -> bool:
+        return self._part_path is None
+
+    def add(self, image):
+        self.frames[self.count] = image
+        self.count += 1
+
+    def finish(self):
+        # The frame count reported by the container can be too high, unused slots are cut off before publishing
+        self.frames.flush()
+        self.frames = None
+        os.truncate(self._part_path, self.count * self.frame_bytes)
+        os.replace(self._part_path, self.path)
+        self._part_path = None
+        self.frames = self._open()
+
+    def close(self):
+        # Only an unfinished first pass is discarded, a complete cache is kept for the next run
+        if self._part_path is not None:
+            self.frames = None
+            os.remove(self._part_path)
+            self._part_path = None
+
+    def _open(self):
+        self.count = os.path.getsize(self.path) // self.frame_bytes
+        return np.memmap(self.path, dtype=np.uint8, mode="r", shape=(self.count, *self.shape))
+
+    def __len__(self):
+        return self.count
+
 
 class VideoReader:
-    def __init__(self, stream_id=0):
+    def __init__(self, stream_id=0, buffer_size=FRAME_BUFFER_SIZE, backpressure=FRAME_BACKPRESSURE, cache=FRAME_CACHE,
+                 cache_pixel=FRAME_CACHE_PIXEL, cache_dir=FRAME_CACHE_DIR):
         # self.stream_id = stream_id  # default is 0 for primary camera
 
         # opening video capture stream
@@ -16,19 +147,40 @@ class VideoReader:
         ROOT = os.path.dirname(__file__)
         self.video_path = ROOT + "/data/QR_Video.mp4"
         self.frame_count = 1
-        self.last_frame_read = False
+        self.sequence = 0
 
         self.vcap = cv2.VideoCapture(self.video_path)
         if self.vcap.isOpened() is False:
             print("[Exiting]: Error accessing webcam stream.")
             exit(0)
+        self.total_frames = self.vcap.get(cv2.CAP_PROP_FRAME_COUNT)
 
         # reading a single frame from vcap stream for initializing
-        self.grabbed, self.frame = self.vcap.read()
+        self.grabbed, frame = self.vcap.read()
         if self.grabbed is False:
             print('[Exiting] No more frames to read')
             exit(0)  # self.stopped is set to False when frames are being read from self.vcap stream
 
+        self.pixel = None  # Height the consumer decodes at, see select_pixel
+        self.cache = None
+        self.scaled_cache = None
+        if cache:
+            self.cache = FrameCache(self.video_path, frame.shape, int(self.total_frames), cache_dir)
+            # Frames pre-scaled to the configured height leave the detector only the grayscale conversion. They are
+            # only served while the detector runs at exactly that height, so cached frames are never upscaled
+            if 0 < cache_pixel < frame.shape[0]:
+                scaled_shape = (cache_pixel, int(frame.shape[1] * cache_pixel / frame.shape[0]), *frame.shape[2:])
+                self.scaled_cache = FrameCache(self.video_path, scaled_shape, int(self.total_frames), cache_dir)
+            if self.cache_complete:
+                self.vcap.release()
+                frame = self.cache.frames[0]
+            else:
+                self.cache_frame(frame)
+
+        self.frame_shape = frame.shape  # The full-resolution shape, pre-scaled frames are smaller
+        self.buffer = FrameBuffer(buffer_size, backpressure)
+        self.buffer.put(Frame(self.sequence, frame))
+
         self.stopped = True  # reference to the thread for reading next available frame from input stream
         self.t = Thread(target=self.update, args=())
         self.t.daemon = True  # daemon threads keep running in the background while the program is executing
@@ -40,34 +192,97 @@ class VideoReader:
 
     def update(self):
         while not self.stopped:
-            if self.last_frame_read:
+            if self.cache_complete:
+                # Read-only view into the mapped file, consumers never write to frames
+                cache = self.scaled_cache if self.serves_scaled() else self.cache
+                frame = cache.frames[self.frame_count % len(cache)]
+                self.frame_count += 1
+            else:
+                frame = self.decode_next()
+                if frame is None:
+                    continue
 
-                if self.frame_count >= self.vcap.get(cv2.CAP_PROP_FRAME_COUNT):
-                    self.frame_count = 1
-                    self.vcap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.sequence += 1
+            # Blocks while the buffer is full, so the decoder only runs as fast as frames are consumed
+            if not self.buffer.put(Frame(self.sequence, frame)):
+                break
 
-                self.grabbed, self.frame = self.vcap.read()
-                self.frame_count += 1
+        self.vcap.release()
+        for cache in self.caches():
+            cache.close()
+
+    def decode_next(self) -> np.ndarray | None:
+        if self.frame_count >= self.total_frames:
+            if self.cache is not None:
+                # The first pass is complete, all following passes are served from the cache
+                for cache in self.caches():
+                    if not cache.complete:
+                        cache.finish()
+                self.vcap.release()
+                self.frame_count = 0
+                return None
+            self.frame_count = 1
+            self.vcap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+        self.grabbed, frame = self.vcap.read()
+        self.frame_count += 1
+        if not self.grabbed:
+            return None
+
+        return self.cache_frame(frame) if self.cache is not None else frame
+
+    def cache_frame(self, frame):
+        # Adds a frame of the first pass to the unfinished caches and returns the version that is served
+        scaled = None
+        if self.scaled_cache is not None and (not self.scaled_cache.complete or self.serves_scaled()):
+            scaled = cv2.resize(frame, (self.scaled_cache.shape[1], self.scaled_cache.shape[0]))
+            if not self.scaled_cache.complete:
+                self.scaled_cache.add(scaled)
+        if not self.cache.complete:
+            self.cache.add(frame)
+        return scaled if self.serves_scaled() else frame
+
+    def caches(self) -> list[FrameCache]:
+        return [cache for cache in (self.cache, self.scaled_cache) if cache is not None]
+
+    @property
+    def cache_complete(self) -> bool:
+        return self.cache is not None and all(cache.complete for cache in self.caches())
+
+    def select_pixel(self, pixel):
+        # Called by the consumer whenever its configured height changes
+        self.pixel = int(pixel)
 
-                self.last_frame_read = False
+    def serves_scaled(self) -> bool:
+        return self.scaled_cache is not None and self.pixel == self.scaled_cache.shape[0]
 
-        self.vcap.release()  # method for returning latest read frame
+    def read_frame(self, timeout=None) -> Frame | None:
+        while True:
+            frame = self.buffer.get(timeout)
+            # Pre-scaled frames queued before the height changed are skipped, the next ones have full resolution
+            if (frame is None or self.scaled_cache is None or self.serves_scaled()
+                    or frame.image.shape[0] != self.scaled_cache.shape[0]):
+                return frame
 
-    def read(self):
-        self.last_frame_read = True
-        return self.frame
+    def read(self, timeout=None):
+        frame = self.read_frame(timeout)
+        return frame.image if frame is not None else None
 
     # @utils.print_execution_time # Takes < 1ms, which I can hardly imagine
     def get_buffer_size_n(self, size):
         buffer = []
-        while len(buffer) < size:
-            frame = self.read()
-            buffer.append(frame)
+        while len(buffer) < size and not self.stopped:
+            frame = self.read(timeout=1.0)
+            if frame is not None:
+                buffer.append(frame)
 
         return buffer
 
     def stop(self):
         self.stopped = True
+        self.buffer.close()
+        if self.t.is_alive():
+            self.t.join(timeout=1.0)
 
 
 
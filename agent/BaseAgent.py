@@ -1,11 +1,8 @@
 import logging
-import threading
-import time
 
 import utils
 from DockerClient import DockerInfo
 from agent.ScalingAgent_v2 import ScalingAgent
-from agent.agent_utils import log_agent_experience
 from slo_config import calculate_slo_reward, PW_MAX_CORES, Full_State
 
 DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.sock")
@@ -14,32 +11,19 @@ DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.soc
 logger = logging.getLogger("multiscale")
 logger.setLevel(logging.DEBUG)
 
-core_state = {}
-access_state = threading.Lock()
-
 
 class BaseAgent(ScalingAgent):
-    def __init__(self, container: DockerInfo, prom_server, thresholds, log=None, max_cores=PW_MAX_CORES):
-        super().__init__(container, prom_server, thresholds, None, log, max_cores)
-
-    def run(self):
-        global core_state
-
-        initial_state = self.get_state_PW()
-        with access_state:
-            core_state = core_state | {self.container.id: initial_state.cores}
-            logger.info(core_state)
-
-        while self._running:
-            state_pw = self.get_state_PW()
-            logger.debug(f"Current state before change is {state_pw}")
-            logger.debug(f"Current SLO-F before change is {calculate_slo_reward(state_pw.for_tensor())}")
-            log_agent_experience(state_pw, self.log) if self.log else None
+    def __init__(self, container: DockerInfo, prom_server, thresholds, log=None, max_cores=PW_MAX_CORES, **clients):
+        super().__init__(container, prom_server, thresholds, None, log, max_cores, **clients)
 
-            action_pw = self.choose_action(state_pw)
-            self.act_on_env(action_pw, state_pw)
+    def iterate(self):
+        state_pw = self.get_state_PW()
+        logger.debug(f"Current state before change is {state_pw}")
+        logger.debug(f"Current SLO-F before change is {calculate_slo_reward(state_pw.for_tensor())}")
+        self.log_experience(state_pw)
 
-            time.sleep(5)
+        action_pw = self.choose_action(state_pw)
+        self.act_on_env(action_pw, state_pw)
 
     def choose_action(self, state: Full_State):
 
@@ -1,11 +1,8 @@
 import logging
 import os
-import random
-from collections import deque
 from datetime import datetime
 
 import numpy as np
-import pandas as pd
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,7 +11,9 @@ from matplotlib import pyplot as plt
 from numpy.linalg import LinAlgError
 
 import utils
+from agent import agent_utils
 from agent.LGBN_Env import LGBN_Env
+from agent.VectorLGBN_Env import VectorLGBN_Env
 
 logger = logging.getLogger("multiscale")
 logging.getLogger("multiscale").setLevel(logging.INFO)
@@ -24,26 +23,35 @@ logger.info(f"Using {"GPU (CUDA)" if torch.cuda.is_available() else "CPU"} for t
 
 if not torch.cuda.is_available():
     torch.set_num_threads(1)
-torch.autograd.set_detect_anomaly(True)
+# Anomaly detection records a stack trace for every autograd op and slows down each backward pass noticeably
+DQN_DEBUG = utils.get_env_param("DQN_DEBUG", "False") == "True"
+torch.autograd.set_detect_anomaly(DQN_DEBUG)
 
 STATE_DIM = 6
 
 
 class DQN:
     def __init__(self, state_dim, action_dim, force_restart=False, neurons=16, nn_folder="../share/networks",
-                 suffix=None):
+                 suffix=None, prioritized_replay=False, persist_memory=False, compile_network=False, lr=0.01,
+                 gamma=0.98, tau=0.01, epsilon_decay=0.95, forgetting=1.0):
         self.state_dim = state_dim
         self.action_dim = action_dim
-        self.lr = 0.01
-        self.gamma = 0.98
-        self.tau = 0.01  # 0.01
+        self.lr = lr
+        self.gamma = gamma
+        self.tau = tau  # 0.01
         self.epsilon = 1.0
-        self.epsilon_decay = 0.95  # 0.98
+        self.epsilon_decay = epsilon_decay  # 0.98
+        self.forgetting = forgetting  # Weight decay per LGBN row, below 1 the env follows drift in the service
         self.epsilon_min = 0.001
         self.buffer_size = 100000
         self.batch_size = 200
-        self.memory = ReplayBuffer(self.buffer_size)
+        self.memory = ReplayBuffer(self.buffer_size, self.state_dim, prioritized=prioritized_replay)
+        self.persist_memory = persist_memory
         self.training_rounds = 1.0
+        self.neurons = neurons
+        self.compile_network = compile_network
+        self.plot_scores = True
+        self.store_networks = True
 
         self.Q = QNetwork(self.state_dim, self.action_dim, self.lr, neurons).to(device)  # Q-Network
         self.Q_target = QNetwork(self.state_dim, self.action_dim, self.lr, neurons).to(device)  # Target Network
@@ -53,7 +61,17 @@ class DQN:
             self.training_rounds = 0.5
             logger.info("Loaded existing Q network on startup")
 
+        replay_file = nn_folder + f"/replay{"" + suffix if suffix else ""}.pt"
+        if persist_memory and not force_restart and os.path.exists(replay_file):
+            self.memory.load(replay_file)
+            logger.info(f"Loaded {self.memory.size()} transitions into the replay buffer")
+
         self.Q_target.load_state_dict(self.Q.state_dict())
+        if compile_network:
+            # Compiled in place, so state_dict keys and stored files stay the same
+            self.Q.compile()
+            self.Q_target.compile()
+
         self.last_time_trained = datetime(1970, 1, 1, 0, 0, 0)
         self.currently_training = False
         self.env = LGBN_Env()
@@ -72,6 +90,18 @@ class DQN:
 
         return action
 
+    @torch.no_grad()
+    def choose_actions(self, states: np.ndarray, rand=None) -> np.ndarray:
+        # Epsilon-greedy for a whole batch of states with a single forward pass
+        if rand is None:
+            rand = self.epsilon
+
+        actions = torch.argmax(self.Q(torch.as_tensor(states, dtype=torch.float32, device=device)), dim=1)
+        actions = actions.cpu().numpy()
+        explore = np.random.rand(len(states)) < rand
+        actions[explore] = np.random.randint(0, self.action_dim, explore.sum())
+        return actions
+
     def calc_target(self, mini_batch):
         s, a, r, s_prime, d = mini_batch
         with torch.no_grad():
@@ -82,7 +112,7 @@ class DQN:
     @utils.print_execution_time
     def train_dqn_from_env(self, df, suffix=None):
 
-        self.env.reload_lgbn_model(df)
+        self.env.reload_lgbn_model(df, self.forgetting)
         try:
             self.env.reset()
             self.currently_training = True
@@ -120,39 +150,112 @@ class DQN:
                 score_list.append(episode_score)
                 episode_score = 0.0
 
-        if logger.level <= logging.INFO:
+        self.finish_training(score_list, suffix)
+        return score_list
+
+    @utils.print_execution_time
+    def train_dqn_from_vec_env(self, df, num_envs=16, suffix=None, updates_per_step=None):
+        """Runs num_envs episodes side by side; total env steps and the final epsilon match train_dqn_from_env.
+
+        Each vectorized step adds num_envs transitions and runs updates_per_step gradient updates. The default of
+        num_envs keeps one update per transition like train_dqn_from_env, fewer trade training for speed.
+        """
+        updates_per_step = num_envs if updates_per_step is None else updates_per_step
+        try:
+            self.env.reload_lgbn_model(df, self.forgetting)
+            vec_env = VectorLGBN_Env(self.env.sampler, num_envs)
+            states = vec_env.reset()
+            self.currently_training = True
+        except LinAlgError as e:
+            logger.warning(f"Could not initialize ENV due to {e.args[0]}, waiting for more samples")
+            return
+
+        episode_scores = np.zeros(num_envs)
+        score_list = []
+        round_counter = 0
+        EPISODE_LENGTH = 100
+        NO_EPISODE = 80
+
+        # At least one full episode, even if num_envs exceeds the number of episodes
+        total_rounds = max(EPISODE_LENGTH, (NO_EPISODE * self.training_rounds) * EPISODE_LENGTH / num_envs)
+
+        self.epsilon = np.clip(self.epsilon, 0, self.training_rounds)
+        while round_counter < total_rounds:
+
+            actions = self.choose_actions(states)
+            next_states, rewards = vec_env.step(actions)
+
+            self.memory.put_batch(states, actions, rewards, next_states, np.zeros(num_envs, dtype=bool))
+            episode_scores += rewards
+            states = next_states
+
+            if self.memory.size() > self.batch_size:
+                for _ in range(updates_per_step):
+                    self.train_batch()
+
+            round_counter += 1
+
+            if round_counter % EPISODE_LENGTH == 0:
+                states = vec_env.reset()
+                self.epsilon *= self.epsilon_decay ** num_envs
+                score_list.append(np.average(episode_scores))
+                episode_scores[:] = 0.0
+
+        self.finish_training(score_list, suffix)
+        return score_list
+
+    def finish_training(self, score_list, suffix):
+        if self.plot_scores and logger.level <= logging.INFO:
             logger.info(f"Average Score for 5 last rounds: {np.average(score_list[-5:])}")
             plt.plot(score_list)
             plt.show()
 
-        self.store_dqn_as_file(suffix=suffix)
+        if self.store_networks:
+            self.store_dqn_as_file(suffix=suffix)
         self.last_time_trained = datetime.now()
         self.currently_training = False
         self.training_rounds = np.clip(self.training_rounds - 0.2, 0.15, 1.0)
         self.epsilon = 1.0
 
+    def swap_network(self, state_dict):
+        # Builds the new network aside and replaces the reference, so concurrent inference sees either one or the other
+        q = QNetwork(self.state_dim, self.action_dim, self.lr, self.neurons).to(device)
+        q.load_state_dict(state_dict)
+        if self.compile_network:
+            q.compile()
+        self.Q = q
+
     # @utils.print_execution_time
     def train_batch(self):
-        mini_batch = self.memory.sample(self.batch_size)
+        if self.memory.prioritized:
+            mini_batch, indices, weights = self.memory.sample_prioritized(self.batch_size)
+        else:
+            mini_batch, indices, weights = self.memory.sample(self.batch_size), None, None
         s_batch, a_batch, r_batch, s_prime_batch, d_batch = mini_batch
-        a_batch = a_batch.type(torch.int64)
 
         td_target = self.calc_target(mini_batch)
 
         #### Q train ####
         Q_a = self.Q(s_batch).gather(1, a_batch)
-        q_loss = F.smooth_l1_loss(Q_a, td_target)
+        if weights is None:
+            q_loss = F.smooth_l1_loss(Q_a, td_target)
+        else:
+            q_loss = weights * F.smooth_l1_loss(Q_a, td_target, reduction='none')
+            self.memory.update_priorities(indices, td_target - Q_a)
         self.Q.optimizer.zero_grad()
         q_loss.mean().backward()
         self.Q.optimizer.step()
 
         #### Q soft-update ####
-        for param_target, param in zip(self.Q_target.parameters(), self.Q.parameters()):
-            param_target.data.copy_(param_target.data * (1.0 - self.tau) + param.data * self.tau)
+        # target + tau * (param - target) for all tensors in one fused call
+        with torch.no_grad():
+            torch._foreach_lerp_(list(self.Q_target.parameters()), list(self.Q.parameters()), self.tau)
 
     # @utils.print_execution_time
     def store_dqn_as_file(self, suffix=None):
         torch.save(self.Q.state_dict(), self.nn_folder + f"/Q{"" + suffix if suffix else ""}.pt")
+        if self.persist_memory:
+            self.memory.save(self.nn_folder + f"/replay{"" + suffix if suffix else ""}.pt")
 
 
 # NO_NEURONS = 16
@@ -174,38 +277,128 @@ class QNetwork(nn.Module):
         return q
 
 
-# ReplayBuffer from https://github.com/seungeunrho/minimalRL
 class ReplayBuffer:
-    def __init__(self, buffer_limit: int):
-        self.buffer = deque(maxlen=buffer_limit)
+    """Ring buffer of transitions in preallocated tensors, sampled by index.
+
+    With prioritized=True, transitions are drawn proportionally to their priority (|TD error| ** alpha) from a
+    SumTree; sample_prioritized then also returns importance sampling weights.
+    """
+
+    def __init__(self, buffer_limit: int, state_dim=STATE_DIM, prioritized=False, alpha=0.6, beta=0.4):
+        self.limit = buffer_limit
+        self.position = 0
+        self.count = 0
+
+        self.states = torch.zeros((buffer_limit, state_dim), dtype=torch.float, device=device)
+        self.actions = torch.zeros((buffer_limit, 1), dtype=torch.int64, device=device)
+        self.rewards = torch.zeros((buffer_limit, 1), dtype=torch.float, device=device)
+        self.next_states = torch.zeros((buffer_limit, state_dim), dtype=torch.float, device=device)
+        self.dones = torch.zeros((buffer_limit, 1), dtype=torch.bool, device=device)
+
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self.tree = SumTree(buffer_limit) if prioritized else None
+        self.max_priority = 1.0
 
     def put(self, transition):
-        self.buffer.append(transition)
+        s, a, r, s_prime, done_mask = transition
+        self.put_batch([s], [a], [r], [s_prime], [done_mask])
 
-    def sample(self, n: int):
-        mini_batch = random.sample(self.buffer, n)
-        s_lst, a_lst, r_lst, s_prime_lst, done_mask_lst = [], [], [], [], []
+    def put_batch(self, s, a, r, s_prime, done_mask):
+        n = len(r)
+        indices = (self.position + torch.arange(n, device=device)) % self.limit
 
-        for transition in mini_batch:
-            s, a, r, s_prime, done_mask = transition
-            s_lst.append(s)
-            a_lst.append([a])
-            r_lst.append([r])
-            s_prime_lst.append(s_prime)
-            done_mask_lst.append([done_mask])
+        self.states[indices] = torch.as_tensor(np.asarray(s), dtype=torch.float, device=device)
+        self.actions[indices, 0] = torch.as_tensor(np.asarray(a), dtype=torch.int64, device=device)
+        self.rewards[indices, 0] = torch.as_tensor(np.asarray(r), dtype=torch.float, device=device)
+        self.next_states[indices] = torch.as_tensor(np.asarray(s_prime), dtype=torch.float, device=device)
+        self.dones[indices, 0] = torch.as_tensor(np.asarray(done_mask), dtype=torch.bool, device=device)
+
+        if self.prioritized:
+            # New transitions get the highest known priority so that each is replayed at least once
+            self.tree.update(indices.cpu().numpy(), np.full(n, self.max_priority ** self.alpha))
+
+        self.position = (self.position + n) % self.limit
+        self.count = min(self.count + n, self.limit)
+
+    def _gather(self, indices):
+        return (self.states[indices], self.actions[indices], self.rewards[indices], self.next_states[indices],
+                self.dones[indices])
+
+    def sample(self, n: int):
+        indices = torch.randint(0, self.count, (n,), device=device)
+        return self._gather(indices)
 
-        s_batch = torch.tensor(s_lst, dtype=torch.float).to(device)
-        a_batch = torch.tensor(np.array(a_lst), dtype=torch.float).to(device)
-        r_batch = torch.tensor(np.array(r_lst), dtype=torch.float).to(device)
-        s_prime_batch = torch.tensor(np.array(s_prime_lst), dtype=torch.float).to(device)
-        d_batch = torch.tensor(done_mask_lst).to(device)
+    def sample_prioritized(self, n: int):
+        indices, priorities = self.tree.sample(n, self.count)
+        probabilities = priorities / self.tree.total()
+        weights = (self.count * probabilities) ** -self.beta
+        weights = torch.as_tensor(weights / weights.max(), dtype=torch.float, device=device).unsqueeze(1)
+        return self._gather(torch.as_tensor(indices, device=device)), indices, weights
 
-        return s_batch, a_batch, r_batch, s_prime_batch, d_batch
+    def update_priorities(self, indices, td_errors: torch.Tensor):
+        priorities = td_errors.detach().abs().squeeze(1).cpu().numpy() + 1e-6
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+        self.tree.update(indices, priorities ** self.alpha)
 
     def size(self):
-        return len(self.buffer)
+        return self.count
+
+    def save(self, path):
+        # Oldest transition first, so that loading into a smaller buffer keeps the most recent ones
+        start = self.position if self.count == self.limit else 0
+        order = (torch.arange(self.count, device=device) + start) % self.limit
+        s, a, r, s_prime, done_mask = (tensor.cpu() for tensor in self._gather(order))
+        torch.save({'states': s, 'actions': a, 'rewards': r, 'next_states': s_prime, 'dones': done_mask}, path)
+
+    def load(self, path):
+        stored = torch.load(path, weights_only=True)
+        n = min(len(stored['rewards']), self.limit)
+        self.position, self.count = 0, 0
+        self.put_batch(stored['states'][-n:].numpy(), stored['actions'][-n:, 0].numpy(),
+                       stored['rewards'][-n:, 0].numpy(), stored['next_states'][-n:].numpy(),
+                       stored['dones'][-n:, 0].numpy())
+
+
+class SumTree:
+    """Binary tree over the buffer slots whose inner nodes hold the sum of their children's priorities."""
+
+    def __init__(self, capacity):
+        self.leaves = 1 << max(capacity - 1, 0).bit_length()
+        self.nodes = np.zeros(2 * self.leaves - 1, dtype=np.float64)
+
+    def total(self):
+        return self.nodes[0]
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices) + self.leaves - 1
+        self.nodes[nodes] = priorities
+
+        # Recompute the parents level by level, every level in one vectorized step
+        while nodes[0] > 0:
+            nodes = np.unique((nodes - 1) // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes + 1] + self.nodes[2 * nodes + 2]
+
+    def sample(self, n, count=None):
+        # Stratified: one uniform draw per equally sized segment of the total priority mass. Rounding can push a
+        # value to the total and into the empty leaves behind the first count ones, so both ends are clamped
+        total = self.total()
+        values = np.minimum((np.arange(n) + np.random.rand(n)) * (total / n), np.nextafter(total, 0))
+        nodes = np.zeros(n, dtype=np.int64)
+
+        while nodes[0] < self.leaves - 1:
+            left = 2 * nodes + 1
+            go_right = values > self.nodes[left]
+            values = np.where(go_right, values - self.nodes[left], values)
+            nodes = np.where(go_right, left + 1, left)
+
+        indices = nodes - (self.leaves - 1)
+        if count is not None:
+            indices = np.minimum(indices, count - 1)
+        return indices, self.nodes[indices + self.leaves - 1]
 
 
 if __name__ == '__main__':
-    df_t = pd.read_csv("../share/metrics/LGBN.csv")
+    df_t = agent_utils.load_lgbn_data("../share/metrics/LGBN.csv")
     DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True).train_dqn_from_env(df_t)
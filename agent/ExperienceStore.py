@@ -0,0 +1,96 @@
+import argparse
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+LGBN_SCHEMA = pa.schema([("timestamp", pa.timestamp("us")), ("fps", pa.float64()), ("pixel", pa.int32()),
+                         ("cores", pa.int32()), ("energy", pa.float64()), ("change_flag", pa.bool_())])
+
+SLO_F_SCHEMA = pa.schema([("index", pa.string()), ("rep", pa.int32()), ("timestamp", pa.timestamp("us")),
+                          ("pixel", pa.int32()), ("pixel_thresh", pa.int32()), ("fps", pa.float64()),
+                          ("fps_thresh", pa.int32()), ("energy", pa.float64()), ("cores", pa.int32()),
+                          ("free_cores", pa.int32())])
+
+PARTITIONING = ds.partitioning(pa.schema([("date", pa.string()), ("hour", pa.int8())]), flavor="hive")
+
+
+class ExperienceStore:
+    """Parquet dataset with typed columns, partitioned by date and hour of the row timestamp.
+
+    Every append adds new files, so nothing existing is rewritten; loads only open the partitions and row groups
+    that can match the timestamp, pixel and cores filters.
+    """
+
+    def __init__(self, root, schema=LGBN_SCHEMA):
+        self.root = root
+        self.schema = schema
+
+    def append(self, df: pd.DataFrame):
+        if len(df) == 0:
+            return
+
+        df = df.copy()
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        for field in self.schema:
+            if pa.types.is_string(field.type):
+                df[field.name] = df[field.name].astype(str)
+        table = pa.Table.from_pandas(df[self.schema.names], schema=self.schema, preserve_index=False)
+
+        timestamps = df['timestamp']
+        table = table.append_column("date", pa.array(timestamps.dt.strftime("%Y-%m-%d"), pa.string()))
+        table = table.append_column("hour", pa.array(timestamps.dt.hour, pa.int8()))
+
+        ds.write_dataset(table, self.root, format="parquet", partitioning=PARTITIONING,
+                         existing_data_behavior="overwrite_or_ignore",
+                         basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet")
+
+    def load(self, since: datetime = None, until: datetime = None, last_hours=None, pixel=None,
+             cores=None) -> pd.DataFrame:
+        if not os.path.isdir(self.root):
+            return pd.DataFrame(columns=self.schema.names)
+
+        if last_hours is not None:
+            since = datetime.now() - timedelta(hours=last_hours)
+
+        dataset = ds.dataset(self.root, format="parquet", partitioning=PARTITIONING)
+        expression = None
+
+        def add(condition):
+            nonlocal expression
+            expression = condition if expression is None else expression & condition
+
+        if since is not None:
+            # The date partition prunes whole directories before the row filter is evaluated
+            add(ds.field("date") >= since.strftime("%Y-%m-%d"))
+            add(ds.field("timestamp") >= pa.scalar(since, pa.timestamp("us")))
+        if until is not None:
+            add(ds.field("date") <= until.strftime("%Y-%m-%d"))
+            add(ds.field("timestamp") <= pa.scalar(until, pa.timestamp("us")))
+        if pixel is not None:
+            add(ds.field("pixel").isin(list(pixel)))
+        if cores is not None:
+            add(ds.field("cores").isin(list(cores)))
+
+        table = dataset.to_table(columns=self.schema.names, filter=expression)
+        return table.to_pandas().sort_values("timestamp", kind="stable").reset_index(drop=True)
+
+
+def convert_csv(csv_path, root, schema=LGBN_SCHEMA, chunk_size=100000):
+    store = ExperienceStore(root, schema)
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        store.append(chunk)
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert LGBN.csv or slo_f.csv into a partitioned Parquet store")
+    parser.add_argument("csv_path")
+    parser.add_argument("root")
+    parser.add_argument("--kind", choices=["lgbn", "slo_f"], default="lgbn")
+    args = parser.parse_args()
+
+    convert_csv(args.csv_path, args.root, LGBN_SCHEMA if args.kind == "lgbn" else SLO_F_SCHEMA)
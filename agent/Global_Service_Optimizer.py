@@ -5,6 +5,7 @@ import pandas as pd
 
 from HttpClient import HttpClient
 from agent import agent_utils
+from agent.LGBN_Env import LGBNSampler
 from agent.ScalingAgent_v2 import ScalingAgent
 from slo_config import Full_State, calculate_slo_reward
 
@@ -16,7 +17,8 @@ logger = logging.getLogger("multiscale")
 class Global_Service_Optimizer:
     def __init__(self, agents: [ScalingAgent]):
         self.s_agents = agents
-        self.lgbn = agent_utils.train_lgbn_model(pd.read_csv("./LGBN.csv"), show_result=False)
+        self.lgbn = agent_utils.train_lgbn_model(agent_utils.load_lgbn_data("./LGBN.csv"), show_result=False)
+        self.sampler = LGBNSampler(self.lgbn)
 
     def estimate_swapping(self):
         state_1: Full_State = self.s_agents[0].get_state_PW()
@@ -36,8 +38,7 @@ class Global_Service_Optimizer:
                 options.append((0, 0, 0))
                 continue
 
-            fps_a = sample_values_from_lgbn(self.lgbn, state_1.pixel, combi[0])
-            fps_b = sample_values_from_lgbn(self.lgbn, state_2.pixel, combi[1])
+            fps_a, fps_b = self.sampler.get_mean([state_1.pixel, state_2.pixel], list(combi))[:, 0]
 
             s_new_1 = state_1._replace(fps=fps_a, cores=combi[0])
             s_new_2 = state_2._replace(fps=fps_b, cores=combi[1])
@@ -64,19 +65,8 @@ class Global_Service_Optimizer:
             self.s_agents[1].act_on_env(4, self.s_agents[1].get_state_PW())  # TODO: Should already be allowed
 
 
-def sample_values_from_lgbn(lgbn, pixel, cores):
-    var, mean, vari = lgbn.predict(pd.DataFrame({'pixel': [pixel], 'cores': [cores]}))
-
-    samples = {}
-    for index, v in enumerate(var):
-        mu, sigma = mean[0][index], np.sqrt(vari[index][index])
-        sample_val = np.random.normal(mu, 0, 1)[0]
-        samples = samples | {v: sample_val}
-
-    return float(samples['fps'])
-
 # if __name__ == "__main__":
-#     lgbn = agent_utils.train_lgbn_model(pd.read_csv("../results/E2/LGBN.csv"), show_result=False)
+#     sampler = LGBNSampler(agent_utils.train_lgbn_model(pd.read_csv("../results/E2/LGBN.csv"), show_result=False))
 #
-#     print(sample_values_from_lgbn(lgbn, 1400, 5))
-#     print(sample_values_from_lgbn(lgbn, 1300, 3))
+#     print(sampler.get_mean(1400, 5))
+#     print(sampler.get_mean(1300, 3))
@@ -3,10 +3,10 @@ from random import randint
 
 import gymnasium
 import numpy as np
-import pandas as pd
 from pgmpy.models import LinearGaussianBayesianNetwork
 
 from agent import agent_utils
+from agent.OnlineLGBN import OnlineLGBN
 from slo_config import calculate_slo_reward, PW_MAX_CORES, Full_State
 
 logger = logging.getLogger("multiscale")
@@ -17,6 +17,10 @@ class LGBN_Env(gymnasium.Env):
         super().__init__()
         self.state: Full_State = None
         self.lgbn: LinearGaussianBayesianNetwork = None
+        self.online_lgbn: OnlineLGBN = None
+        self.sampler: LGBNSampler = None
+        self.first_timestamp = None
+        self.last_timestamp = None
 
     def step(self, action):
         punishment_off = 0
@@ -47,18 +51,9 @@ class LGBN_Env(gymnasium.Env):
         reward = np.sum(calculate_slo_reward(self.state.for_tensor())) + punishment_off
         return self.state, reward, False, False, {}
 
-    # @utils.print_execution_time
-    # NTH: Make this more modular
     def sample_values_from_lgbn(self, pixel, cores):
-        var, mean, vari = self.lgbn.predict(pd.DataFrame({'pixel': [pixel], 'cores': [cores]}))
-
-        samples = {}
-        for index, v in enumerate(var):
-            mu, sigma = mean[0][index], np.sqrt(vari[index][index])
-            sample_val = np.random.normal(mu, sigma, 1)[0]
-            samples = samples | {v: sample_val}
-
-        return float(samples['fps']), int(samples['energy'])
+        fps, energy = self.sampler.sample(pixel, cores)
+        return float(fps[0]), int(energy[0])
 
     def reset(self, seed=None, options=None):
         super().reset(seed=seed)
@@ -72,6 +67,72 @@ class LGBN_Env(gymnasium.Env):
         self.state = Full_State(pixel, pixel_thresh, fps, fps_thresh, energy, cores, avail_cores)
         return self.state, {}
 
-    def reload_lgbn_model(self, df):
-        self.lgbn = agent_utils.train_lgbn_model(df, show_result=False)
-        logger.info("Retrained LGBN model for Env")
+    def reload_lgbn_model(self, df, forgetting=1.0):
+        df_filtered = agent_utils.filter_3s_after_change(df.copy())
+        timestamps = df_filtered['timestamp']
+
+        # Only rows that were appended since the last reload are fed into the running statistics; another data
+        # source (e.g., a different partition) or another forgetting factor starts from scratch
+        if self.online_lgbn is None or len(timestamps) == 0 or timestamps.iloc[0] != self.first_timestamp \
+                or self.online_lgbn.forgetting != forgetting:
+            self.online_lgbn = OnlineLGBN(forgetting=forgetting)
+            self.first_timestamp = timestamps.iloc[0] if len(timestamps) > 0 else None
+            self.last_timestamp = None
+
+        new_rows = df_filtered if self.last_timestamp is None else df_filtered[timestamps > self.last_timestamp]
+        self.online_lgbn.partial_fit(new_rows)
+        if len(new_rows) > 0:
+            self.last_timestamp = new_rows['timestamp'].iloc[-1]
+
+        self.lgbn = self.online_lgbn.to_model()
+        self.sampler = LGBNSampler(self.lgbn)
+        logger.info(f"Updated LGBN model for Env with {len(new_rows)} new rows")
+
+
+class LGBNSampler:
+    """Draws fps and energy for whole batches of (pixel, cores) pairs from the CPD coefficients of a fitted LGBN.
+
+    Both targets only depend on pixel and cores, so their conditional distribution is the linear-Gaussian CPD
+    itself; the means are precomputed for the discrete grid that the agents move on.
+    """
+
+    def __init__(self, lgbn: LinearGaussianBayesianNetwork, targets=('fps', 'energy'), pixel_step=100,
+                 max_pixel=2000, max_cores=PW_MAX_CORES):
+        self.targets = list(targets)
+        self.pixel_step = pixel_step
+
+        # Row i holds [intercept, pixel coefficient, cores coefficient] of target i
+        self.coefficients = np.zeros((len(self.targets), 3))
+        self.std = np.zeros(len(self.targets))
+        for i, target in enumerate(self.targets):
+            cpd = lgbn.get_cpds(node=target)
+            if not set(cpd.evidence) <= {'pixel', 'cores'}:
+                raise ValueError(f"{target} depends on {cpd.evidence}, which are not all given")
+
+            self.coefficients[i, 0] = cpd.mean[0]
+            for j, evidence in enumerate(cpd.evidence):
+                self.coefficients[i, 1 if evidence == 'pixel' else 2] = cpd.mean[j + 1]
+            self.std[i] = np.sqrt(cpd.variance)
+
+        pixel_grid, cores_grid = np.meshgrid(np.arange(0, max_pixel + 1, pixel_step), np.arange(0, max_cores + 1),
+                                             indexing='ij')
+        self.mean_grid = self._linear_mean(pixel_grid, cores_grid)  # Shape (pixel / step, cores, targets)
+
+    def _linear_mean(self, pixel, cores):
+        return (self.coefficients[:, 0] + np.multiply.outer(pixel, self.coefficients[:, 1])
+                + np.multiply.outer(cores, self.coefficients[:, 2]))
+
+    def get_mean(self, pixel, cores) -> np.ndarray:
+        pixel, cores = np.atleast_1d(pixel), np.atleast_1d(cores)
+        pixel_index = pixel // self.pixel_step
+
+        on_grid = ((pixel % self.pixel_step == 0) & (pixel_index >= 0) & (pixel_index < self.mean_grid.shape[0])
+                   & (cores >= 0) & (cores < self.mean_grid.shape[1]) & (cores == np.round(cores)))
+        if np.all(on_grid):
+            return self.mean_grid[pixel_index.astype(int), cores.astype(int)]
+        return self._linear_mean(pixel, cores)
+
+    def sample(self, pixel, cores, rng=np.random):
+        mean = self.get_mean(pixel, cores)
+        samples = rng.normal(mean, self.std)
+        return tuple(samples[:, i] for i in range(len(self.targets)))
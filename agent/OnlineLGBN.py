@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+from pgmpy.factors.continuous import LinearGaussianCPD
+from pgmpy.models import LinearGaussianBayesianNetwork
+
+from agent import agent_utils
+
+
+class OnlineLinearGaussianCPD:
+    """Least-squares fit of one node on its parents, kept as running sufficient statistics.
+
+    With forgetting < 1 every row weighs forgetting times less than the one after it, so the estimate follows drift.
+    """
+
+    def __init__(self, variable, evidence, forgetting=1.0):
+        self.variable = variable
+        self.evidence = list(evidence)
+        self.forgetting = forgetting
+
+        k = len(self.evidence) + 1
+        self.xtx = np.zeros((k, k))
+        self.xty = np.zeros(k)
+        self.yty = 0.0
+        self.count = 0.0
+        self._params = None
+
+    def update(self, x: np.ndarray, y: np.ndarray):
+        n = len(y)
+        if n == 0:
+            return
+
+        design = np.column_stack([np.ones(n), x])
+        weights = self.forgetting ** np.arange(n - 1, -1, -1, dtype=np.float64)
+        decay = self.forgetting ** n
+
+        weighted = design * weights[:, None]
+        self.xtx = decay * self.xtx + weighted.T @ design
+        self.xty = decay * self.xty + weighted.T @ y
+        self.yty = decay * self.yty + np.dot(weights * y, y)
+        self.count = decay * self.count + weights.sum()
+        self._params = None
+
+    def get_parameters(self):
+        if self._params is None:
+            beta = np.linalg.lstsq(self.xtx, self.xty, rcond=None)[0]
+            sse = self.yty - 2 * beta @ self.xty + beta @ self.xtx @ beta
+            # Same unbiased estimate as the pandas var() that pgmpy applies to the residuals
+            variance = max(sse, 0.0) / max(self.count - 1, 1.0)
+            self._params = beta, float(variance)
+        return self._params
+
+    def to_cpd(self) -> LinearGaussianCPD:
+        beta, variance = self.get_parameters()
+        return LinearGaussianCPD(variable=self.variable, evidence_mean=beta, evidence_variance=variance,
+                                 evidence=self.evidence)
+
+
+class OnlineLGBN:
+    """Linear Gaussian Bayesian network whose CPDs are updated row by row instead of refitted from the full data."""
+
+    def __init__(self, edges=agent_utils.LGBN_EDGES, forgetting=1.0):
+        self.edges = edges
+        self.forgetting = forgetting
+        structure = LinearGaussianBayesianNetwork(edges)
+        self.cpds = {node: OnlineLinearGaussianCPD(node, structure.get_parents(node), forgetting)
+                     for node in structure.nodes()}
+        self.rows = 0
+
+    def partial_fit(self, df: pd.DataFrame):
+        for node, cpd in self.cpds.items():
+            x = df[cpd.evidence].to_numpy(dtype=np.float64)
+            cpd.update(x, df[node].to_numpy(dtype=np.float64))
+        self.rows += len(df)
+
+    def to_model(self) -> LinearGaussianBayesianNetwork:
+        model = LinearGaussianBayesianNetwork(self.edges)
+        model.add_cpds(*[cpd.to_cpd() for cpd in self.cpds.values()])
+        return model
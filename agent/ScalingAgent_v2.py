@@ -9,13 +9,17 @@ import numpy as np
 import utils
 from DockerClient import DockerClient, DockerInfo
 from HttpClient import HttpClient
-from PrometheusClient import PrometheusClient
+from PrometheusClient import MetricsPoller, PrometheusClient
+from Telemetry import TelemetrySubscriber
 from agent.DQN import DQN
 from agent.DQN import STATE_DIM
+from agent.TrainingService import TrainingService
 from agent.agent_utils import get_free_cores, log_agent_experience
 from slo_config import MB, calculate_slo_reward, Full_State, PW_MAX_CORES
 
 DOCKER_SOCKET = utils.get_env_param('DOCKER_SOCKET', "unix:///var/run/docker.sock")
+BACKGROUND_TRAINING = utils.get_env_param('BACKGROUND_TRAINING', "False") == "True"
+LGBN_SOURCE = utils.get_env_param('LGBN_SOURCE', "../share/metrics/LGBN.csv")
 # MAX_CORES = utils.get_env_param('MAX_CORES', 10)
 
 logger = logging.getLogger("multiscale")
@@ -26,19 +30,32 @@ access_state = threading.Lock()
 
 
 class ScalingAgent(Thread):
-    def __init__(self, container: DockerInfo, prom_server, thresholds, dqn=None, log=None, max_cores=PW_MAX_CORES):
+    def __init__(self, container: DockerInfo, prom_server, thresholds, dqn=None, log=None, max_cores=PW_MAX_CORES,
+                 training_service=None, prom_client=None, docker_client=None, http_client=None, clock=None,
+                 metrics_poller: MetricsPoller = None, telemetry: TelemetrySubscriber = None):
         super().__init__()
 
         self.container = container
-        self.prom_client = PrometheusClient(prom_server)
-        self.docker_client = DockerClient(DOCKER_SOCKET)
-        self.http_client = HttpClient()
+        # Clients and clock can be injected, e.g., by agent.Simulation to run without containers
+        self.prom_client = prom_client or PrometheusClient(prom_server)
+        self.docker_client = docker_client or DockerClient(DOCKER_SOCKET)
+        self.http_client = http_client or HttpClient()
+        self.clock = clock
+
+        # A poller shared between agents replaces the per-agent Prometheus queries
+        self.metrics_poller = metrics_poller
+        if self.metrics_poller is not None:
+            self.metrics_poller.register(self.container.ip_a)
+        # The telemetry stream of the service is preferred while it delivers, Prometheus stays the fallback
+        self.telemetry = telemetry
         self.log = log
         self.max_cores = max_cores
 
         self.dqn = dqn
         if self.dqn is None:
             self.dqn = DQN(state_dim=STATE_DIM, action_dim=5)
+        self.training_service = training_service
+        self.policy_version = 0
 
         # Explore 4 combinations of Pixel / Cores if the model was not trained before
         self.explore_initial = list(itertools.product([500, 1200], [3, 7])) if self.dqn.training_rounds != 0.5 else []
@@ -48,6 +65,13 @@ class ScalingAgent(Thread):
         self._idle = False
 
     def run(self):
+        self.register_cores()
+
+        while self._running:
+            self.iterate()
+            time.sleep(5)
+
+    def register_cores(self):
         global core_state
 
         initial_state = self.get_state_PW()
@@ -55,30 +79,42 @@ class ScalingAgent(Thread):
             core_state = core_state | {self.container.id: initial_state.cores}
             logger.info(core_state)
 
-        while self._running:
-            # TRAINING OCCASIONALLY ##### # TODO: Pause this for now, it only destroys the result
-            # if not self.dqn.currently_training and datetime.now() - self.dqn.last_time_trained > timedelta(seconds=60):
-            #     Thread(target=self.dqn.train_dqn_from_env, args=(), daemon=True).start()
+    def iterate(self):
+        # TRAINING OCCASIONALLY ##### Happens in the training service, here we only pick up new versions
+        self.swap_policy()
 
-            # REAL INFERENCE ############
-            state_pw = self.get_state_PW()
-            logger.debug(f"Current state before change is {state_pw}")
-            logger.debug(f"Current SLO-F before change is {calculate_slo_reward(state_pw.for_tensor())}")
-            log_agent_experience(state_pw, self.log) if self.log else None
+        # REAL INFERENCE ############
+        state_pw = self.get_state_PW()
+        logger.debug(f"Current state before change is {state_pw}")
+        logger.debug(f"Current SLO-F before change is {calculate_slo_reward(state_pw.for_tensor())}")
+        self.log_experience(state_pw)
 
-            if len(self.explore_initial) > 0:
-                action_pw = 5  # Indicate exploration path
-            else:
-                action_pw = self.dqn.choose_action(np.array(state_pw.for_tensor()), rand=0.15)
+        if len(self.explore_initial) > 0:
+            action_pw = 5  # Indicate exploration path
+        else:
+            action_pw = self.dqn.choose_action(np.array(state_pw.for_tensor()), rand=0.15)
 
-            if not self._idle:
-                self.act_on_env(action_pw, state_pw)
+        if not self._idle:
+            self.act_on_env(action_pw, state_pw)
 
-            time.sleep(5)
+    def log_experience(self, state_pw: Full_State):
+        if self.log:
+            log_agent_experience(state_pw, self.log, self.clock.now() if self.clock else None)
 
     def stop(self):
         self._running = False
 
+    def swap_policy(self):
+        if self.training_service is None:
+            return
+
+        policy = self.training_service.poll(self.policy_version)
+        if policy is not None:
+            self.dqn.swap_network(policy.state_dict)
+            self.policy_version = policy.version
+            source = f" from {policy.path}" if policy.path else ""
+            logger.info(f"{self.container.alias}| Swapped in network v{policy.version}{source}")
+
     def set_idle(self, idle):
         self._idle = idle
 
@@ -95,17 +131,17 @@ class ScalingAgent(Thread):
         period = (self.unchanged_iterations + 1) * 2
         prom_metrics = {}
         while len(prom_metrics) < 1:
-            prom_metrics = self.prom_client.get_metrics(metric_str, period=f"{period}s", instance=self.container.ip_a)
+            prom_metrics = self.query_metrics(metric_str, period=f"{period}s")
             if len(prom_metrics) < 1:
                 logger.warning("Need to query metrics again, result was incomplete")
-                time.sleep(0.1)
+                self.wait_for_metrics()
 
         prom_parameters = {}
         while len(prom_parameters) < 2:
-            prom_parameters = self.prom_client.get_metrics("|".join(MB['parameter']), instance=self.container.ip_a)
+            prom_parameters = self.query_metrics("|".join(MB['parameter']))
             if len(prom_parameters) < 2:
                 logger.warning("Need to query parameters again, result was incomplete")
-                time.sleep(0.1)
+                self.wait_for_metrics()
 
         with access_state:
             free_cores = get_free_cores(core_state, self.max_cores)
@@ -115,6 +151,24 @@ class ScalingAgent(Thread):
                                 0, state_dict['cores'], state_dict['free_cores'])
         return state_pw_f
 
+    def query_metrics(self, metric_str, period=None):
+        if self.telemetry is not None and self.telemetry.is_live():
+            return self.telemetry.get_metrics(metric_str, period=period)
+
+        if self.metrics_poller is None:
+            return self.prom_client.get_metrics(metric_str, period=period, instance=self.container.ip_a)
+
+        if self.metrics_poller.age() > 2 * self.metrics_poller.interval:
+            logger.warning(f"{self.container.alias}| Metrics are {self.metrics_poller.age():.1f}s old")
+        return self.metrics_poller.get_metrics(metric_str, period=period, instance=self.container.ip_a)
+
+    def wait_for_metrics(self):
+        # With a poller, asking again only helps once the next poll arrived
+        if self.metrics_poller is None:
+            time.sleep(0.1)
+        else:
+            self.metrics_poller.wait_for_update(timeout=2 * self.metrics_poller.interval)
+
     def act_on_env(self, action, state_f: Full_State):
         global core_state
         if action == 0:
@@ -153,8 +207,7 @@ class ScalingAgent(Thread):
             pixel, cores = self.explore_initial.pop()
             logger.info(f"{self.container.alias}| Setting up interpolation, moving config to {pixel, cores}")
 
-            self.http_client.change_config(self.container.ip_a, {'pixel': int(pixel)})
-            self.http_client.change_threads(self.container.ip_a, int(cores))
+            self.http_client.reconfigure(self.container.ip_a, pixel=int(pixel), cores=int(cores))
             with access_state:
                 core_state = core_state | {self.container.id: cores}
                 logger.info(core_state)
@@ -173,7 +226,17 @@ def reset_core_states_2(container: [DockerInfo], core):
 
 if __name__ == '__main__':
     ps = "http://172.18.0.2:9090"
+    poller = MetricsPoller(PrometheusClient(ps))
+    poller.start()
+    telemetry_a = TelemetrySubscriber("172.18.0.4")
+    telemetry_a.start()
+    # Retrains in a separate process and hands accepted networks to the agent between two iterations
+    shared_dqn, service = DQN(state_dim=STATE_DIM, action_dim=5), None
+    if BACKGROUND_TRAINING:
+        service = TrainingService(shared_dqn, LGBN_SOURCE, in_process=True)
+        service.start()
     ScalingAgent(container=DockerInfo("multiscaler-video-processing-a-1", "172.18.0.4", "Alice"), prom_server=ps,
-                 thresholds=(1400, 25)).start()
+                 thresholds=(1400, 25), dqn=shared_dqn, training_service=service, metrics_poller=poller,
+                 telemetry=telemetry_a).start()
     # ScalingAgent(container=DockerInfo("multiscaler-video-processing-b-1", "172.18.0.5", "Bob"), prom_server=ps,
-    #              thresholds=(1400, 25)).start()
+    #              thresholds=(1400, 25), metrics_poller=poller).start()
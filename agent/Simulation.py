@@ -0,0 +1,173 @@
+import csv
+import logging
+import os
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+import torch
+
+import utils
+from DockerClient import DockerInfo
+from agent import agent_utils
+from agent.LGBN_Env import LGBNSampler
+from agent.ScalingAgent_v2 import reset_core_states
+from agent.agent_utils import SLO_F_HEADER
+
+logger = logging.getLogger("multiscale")
+
+ITERATION_S = 5  # Agents sleep this long between two iterations
+START_TIME = datetime(2024, 1, 1, 0, 0, 0)
+
+
+class VirtualClock:
+    """Time that only moves when the simulation sleeps, so a 50 s experiment takes as long as its computation."""
+
+    def __init__(self, start=START_TIME):
+        self.current = start
+
+    def now(self) -> datetime:
+        return self.current
+
+
+class SimulatedService:
+    """Video processing service whose FPS is drawn from the LGBN for the currently configured pixel and cores."""
+
+    def __init__(self, sampler: LGBNSampler, rng: np.random.Generator, pixel=800, cores=1):
+        self.sampler = sampler
+        self.rng = rng
+        self.pixel = pixel
+        self.cores = cores
+
+    def sample_fps(self, period_s=None) -> float:
+        # Prometheus averages the 4 Hz gauge over the period, so a longer period gives a less noisy value
+        samples = max(1, int((period_s or 0) * 4))
+        fps, _ = self.sampler.sample(np.full(samples, self.pixel), np.full(samples, self.cores), rng=self.rng)
+        return float(np.average(fps))
+
+
+class FakePrometheusClient:
+    def __init__(self, services: dict[str, SimulatedService]):
+        self.services = services
+
+    def get_metrics(self, metric_name, period=None, instance=None):
+        service = self.services[instance]
+        period_s = float(period.rstrip("s")) if period is not None else None
+        values = {"fps": lambda: service.sample_fps(period_s), "pixel": lambda: float(service.pixel),
+                  "cores": lambda: float(service.cores)}
+        return {name: values[name]() for name in metric_name.split("|") if name in values}
+
+
+class FakeHttpClient:
+    def __init__(self, services: dict[str, SimulatedService]):
+        self.services = services
+
+    def change_config(self, target, config):
+        self.services[target].pixel = int(config['pixel'])
+
+    def change_threads(self, target, number):
+        self.services[target].cores = int(number)
+
+    def reconfigure(self, target, pixel=None, cores=None, thread_multiplier=None) -> float:
+        if pixel is not None:
+            self.change_config(target, {'pixel': pixel})
+        if cores is not None:
+            self.change_threads(target, cores)
+        return 0.0
+
+
+class FakeDockerClient:
+    def update_cpu(self, container_ref, cpus):
+        pass
+
+
+class Simulation:
+    """Runs agents against LGBN-backed services on a virtual clock instead of containers and Prometheus.
+
+    Started agents are not threads but get their iterate() called whenever sleep() passes the time at which the
+    thread would have woken up; one agent after another, which makes a run deterministic for a given seed.
+    """
+
+    def __init__(self, lgbn_source="./LGBN.csv", seed=0, iteration_s=ITERATION_S):
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+
+        self.rng = np.random.default_rng(seed)
+        self.clock = VirtualClock()
+        self.iteration_s = iteration_s
+        lgbn = agent_utils.train_lgbn_model(agent_utils.load_lgbn_data(lgbn_source), show_result=False)
+        self.sampler = LGBNSampler(lgbn)
+
+        self.services: dict[str, SimulatedService] = {}
+        self.prom_client = FakePrometheusClient(self.services)
+        self.http_client = FakeHttpClient(self.services)
+        self.docker_client = FakeDockerClient()
+        self.agents = {}  # Agent -> virtual time of its next iteration
+
+    def clients(self) -> dict:
+        # Keyword arguments that make ScalingAgent and BaseAgent talk to this simulation
+        return {"prom_client": self.prom_client, "http_client": self.http_client,
+                "docker_client": self.docker_client, "clock": self.clock}
+
+    def reset_service(self, container: DockerInfo, pixel, cores):
+        service = self.services.get(container.ip_a)
+        if service is None:
+            service = SimulatedService(self.sampler, self.rng)
+            self.services[container.ip_a] = service
+        service.pixel, service.cores = int(pixel), int(cores)
+
+    def reset_services(self, params_by_container: dict):
+        for container, (pixel, cores) in params_by_container.items():
+            self.reset_service(container, pixel, cores)
+
+    def start_agent(self, agent):
+        # Counterpart of agent.start(), the first iteration follows right away like in ScalingAgent.run
+        agent.register_cores()
+        self.agents[agent] = self.clock.now()
+
+    def sleep(self, seconds):
+        end = self.clock.now() + timedelta(seconds=seconds)
+        while True:
+            due = [(wake_up, agent) for agent, wake_up in self.agents.items() if wake_up < end]
+            if not due:
+                break
+            wake_up, agent = min(due, key=lambda item: item[0])
+
+            self.clock.current = max(self.clock.current, wake_up)
+            if not agent._running:
+                del self.agents[agent]
+                continue
+            agent.iterate()
+            self.agents[agent] = wake_up + timedelta(seconds=self.iteration_s)
+        self.clock.current = end
+
+
+def replay_routine(simulation: Simulation, routine_file, container: DockerInfo, create_agent, run_s=50, settle_s=2,
+                   start_pixel_t=False):
+    """Replays every row of a test routine like E1 does live: reset the service, then let an agent act for run_s.
+
+    create_agent(index, rep, thresholds, max_cores) returns the agent for one row; its experience goes to slo_f.csv.
+    With start_pixel_t, the service starts from the pixel threshold instead of the pixel of the row.
+    """
+    with open(routine_file, mode='r') as file:
+        csv_reader = csv.reader(file)
+        next(csv_reader)
+
+        for row in csv_reader:
+            i, j, pixel, cores, pixel_t, fps_t, max_cores = tuple(map(int, row))
+            simulation.reset_service(container, pixel_t if start_pixel_t else pixel, cores)
+            reset_core_states(container, cores)
+            simulation.sleep(settle_s)
+
+            agent = create_agent(i, j, (pixel_t, fps_t), max_cores)
+            simulation.start_agent(agent)
+            simulation.sleep(run_s)
+            agent.stop()
+
+    flush_experience()
+
+
+def flush_experience():
+    # Rows are written from a background thread, the file is only complete once the queue is drained
+    utils.get_metrics_writer(os.path.join("./", "slo_f.csv"), SLO_F_HEADER).flush()
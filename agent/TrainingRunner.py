@@ -0,0 +1,126 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+
+import matplotlib
+import numpy as np
+import pandas as pd
+import torch
+
+from agent import agent_utils
+from agent.DQN import DQN, STATE_DIM
+
+logger = logging.getLogger("multiscale")
+
+HYPERPARAMETERS = ["lr", "gamma", "tau", "neurons", "epsilon_decay", "forgetting"]
+INDEX_FILE = "index.csv"
+
+
+@dataclass(frozen=True)
+class TrainingJob:
+    name: str  # Becomes the suffix of the model file, i.e., Q{name}.pt
+    lgbn_source: str
+    end_index: int = None  # Train on the first end_index rows only; None uses all of them
+    hyperparameters: dict = field(default_factory=dict)
+    seed: int = 0
+
+
+def hyperparameter_grid(**grid) -> list[dict]:
+    # hyperparameter_grid(lr=[0.01, 0.005], neurons=[16]) -> [{'lr': 0.01, 'neurons': 16}, {'lr': 0.005, ...}]
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+
+
+def init_worker():
+    # Every process trains its own small network; more torch threads per process only contend for the cores
+    torch.set_num_threads(1)
+    matplotlib.use("Agg")
+
+
+def run_job(job: TrainingJob, nn_folder, num_envs=None) -> dict:
+    random.seed(job.seed)
+    np.random.seed(job.seed)
+    torch.manual_seed(job.seed)
+
+    df = agent_utils.load_lgbn_data(job.lgbn_source)
+    if job.end_index is not None:
+        df = df.iloc[:job.end_index]
+
+    start = time.perf_counter()
+    dqn = DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True, nn_folder=nn_folder, **job.hyperparameters)
+    dqn.plot_scores = False
+    if num_envs is None:
+        scores = dqn.train_dqn_from_env(df=df, suffix=job.name)
+    else:
+        scores = dqn.train_dqn_from_vec_env(df=df, num_envs=num_envs, suffix=job.name)
+    scores = scores or []
+
+    parameters = {name: getattr(dqn, name) for name in HYPERPARAMETERS}
+    return {"name": job.name, "rows": len(df), "seed": job.seed, **parameters,
+            "final_score": float(np.average(scores[-5:])) if scores else None,
+            "duration_s": round(time.perf_counter() - start, 2), "model_file": nn_folder + f"/Q{job.name}.pt",
+            "scores": json.dumps([round(float(s), 3) for s in scores])}
+
+
+def run_jobs(jobs: list[TrainingJob], nn_folder, max_workers=None, num_envs=None, index_file=INDEX_FILE):
+    """Trains all jobs on a process pool and writes one index row per job next to the model files."""
+    os.makedirs(nn_folder, exist_ok=True)
+    max_workers = max_workers or min(len(jobs), os.cpu_count())
+
+    # Spawned instead of forked, a forked torch or OpenMP runtime can deadlock in the child
+    context = multiprocessing.get_context("spawn")
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, initializer=init_worker) as executor:
+        futures = {executor.submit(run_job, job, nn_folder, num_envs): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                results.append(future.result())
+                logger.info(f"Finished training {job.name} ({len(results)}/{len(jobs)})")
+            except Exception as e:
+                logger.error(f"Training {job.name} failed; {e!r}")
+                results.append({"name": job.name, "seed": job.seed, **job.hyperparameters, "error": repr(e)})
+
+    index = pd.DataFrame(results).sort_values("name", key=lambda names: names.map(str)).reset_index(drop=True)
+    index.to_csv(os.path.join(nn_folder, index_file), index=False)
+    return index
+
+
+def partition_jobs(lgbn_source, end_indices, grid=None, seed=0) -> list[TrainingJob]:
+    # One job per partition and hyperparameter combination; the plain partition number is kept when there is no grid
+    combinations = hyperparameter_grid(**grid) if grid else [{}]
+    jobs = []
+    for i, end_index in enumerate(end_indices):
+        for k, hyperparameters in enumerate(combinations):
+            name = f"{i + 1}" if len(combinations) == 1 else f"{i + 1}_{k}"
+            jobs.append(TrainingJob(name, lgbn_source, end_index, hyperparameters, seed))
+    return jobs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train DQNs for LGBN partitions and hyperparameter grids in parallel")
+    parser.add_argument("lgbn_source")
+    parser.add_argument("nn_folder")
+    parser.add_argument("--end-indices", type=int, nargs="+", default=[None])
+    parser.add_argument("--lr", type=float, nargs="+")
+    parser.add_argument("--gamma", type=float, nargs="+")
+    parser.add_argument("--tau", type=float, nargs="+")
+    parser.add_argument("--neurons", type=int, nargs="+")
+    parser.add_argument("--epsilon-decay", type=float, nargs="+")
+    parser.add_argument("--forgetting", type=float, nargs="+")
+    parser.add_argument("--num-envs", type=int)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    grid = {name: getattr(args, name) for name in HYPERPARAMETERS if getattr(args, name) is not None}
+    training_jobs = partition_jobs(args.lgbn_source, args.end_indices, grid, args.seed)
+    print(run_jobs(training_jobs, args.nn_folder, args.workers, args.num_envs)
+          .drop(columns="scores", errors="ignore").to_string())
@@ -0,0 +1,208 @@
+import copy
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from numpy.linalg import LinAlgError
+
+import utils
+from agent import agent_utils
+from agent.DQN import DQN
+from agent.LGBN_Env import LGBN_Env
+from agent.TrainingRunner import init_worker
+from agent.VectorLGBN_Env import VectorLGBN_Env
+
+logger = logging.getLogger("multiscale")
+
+TRAINING_INTERVAL = float(utils.get_env_param('TRAINING_INTERVAL', 60))
+HOLDOUT_SHARE = 0.2
+MIN_HOLDOUT_ROWS = 50
+VALIDATION_ENVS = 64
+VALIDATION_STEPS = 100
+
+
+class PolicyVersion(NamedTuple):
+    version: int
+    state_dict: dict
+    score: float
+    path: str  # None for the initial network, which is not written again
+
+
+class TrainingConfig(NamedTuple):
+    # Everything a training round needs besides the weights, small enough to be sent to the training process
+    lgbn_source: str
+    holdout: float
+    last_hours: float
+    num_envs: int
+    state_dim: int
+    action_dim: int
+    neurons: int
+    nn_folder: str
+    forgetting: float
+
+
+class TrainingService(threading.Thread):
+    """Retrains a copy of the agent's DQN in the background and publishes networks that pass validation.
+
+    Training works on a snapshot of the live weights, so the agent's network, epsilon and env are never touched;
+    agents pick up a published version through poll() and DQN.swap_network between two iterations. With in_process
+    the rounds run in a spawned worker process, so that training does not compete with inference for the GIL.
+    """
+
+    def __init__(self, dqn: DQN, lgbn_source, interval=TRAINING_INTERVAL, holdout=HOLDOUT_SHARE, tolerance=0.0,
+                 last_hours=None, num_envs=16, forgetting=None, in_process=False):
+        super().__init__(daemon=True)
+        self.dqn = dqn
+        self.interval = interval
+        self.tolerance = tolerance
+        self.in_process = in_process
+        self.config = TrainingConfig(lgbn_source, holdout, last_hours, num_envs, dqn.state_dim, dqn.action_dim,
+                                     dqn.neurons, dqn.nn_folder, dqn.forgetting if forgetting is None else forgetting)
+        # Shared by all candidates, so every round only feeds the rows that arrived since the last one into the LGBN;
+        # in a worker process, the worker keeps its own
+        self.env = LGBN_Env()
+        self._executor = None
+
+        # The network the agent started with is version 0, so that there is always a version to roll back to
+        self.version = 0
+        self.latest = PolicyVersion(0, copy.deepcopy(dqn.Q.state_dict()), None, None)
+        self.published = [self.latest]
+        self.rejected = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while not self._stop_event.wait(self.interval):
+                try:
+                    self.train_once()
+                except (LinAlgError, ValueError) as e:
+                    logger.warning(f"Background training skipped, data not usable yet; {e.args}")
+                except BrokenProcessPool as e:
+                    logger.error(f"Training process died, starting a new one; {e!r}")
+                    self._executor.shutdown(wait=False)
+                    self._executor = None
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def poll(self, current_version=0) -> PolicyVersion:
+        with self._lock:
+            latest = self.latest
+        return latest if latest is not None and latest.version > current_version else None
+
+    def reject(self, version):
+        # Withdraws a published version, e.g., when it misbehaves on the real service. The network that was
+        # published before is republished under a new version number, so agents that already swapped roll back
+        with self._lock:
+            if self.latest.version != version or len(self.published) < 2:
+                return
+            self.rejected.append(self.published.pop())
+            self.version += 1
+            self.latest = self.published[-1]._replace(version=self.version)
+            self.published.append(self.latest)
+
+    def train_once(self):
+        # The live network may be swapped or trained meanwhile, so the snapshot is taken once and copied
+        baseline_weights = copy.deepcopy(self.dqn.Q.state_dict())
+        if not self.in_process:
+            result = train_candidate(self.env, self.config, baseline_weights, self.dqn.training_rounds)
+        else:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=init_worker)
+            result = self._executor.submit(train_candidate_in_worker, self.config, baseline_weights,
+                                           self.dqn.training_rounds).result()
+        if result is None:
+            return None
+        candidate_weights, score, baseline_score = result
+
+        with self._lock:
+            self.version += 1
+            version = self.version
+        policy = PolicyVersion(version, candidate_weights, score, self.config.nn_folder + f"/Q_v{version}.pt")
+
+        if score < baseline_score - self.tolerance:
+            logger.warning(f"Rejected network v{version}, holdout reward {score:.2f} < {baseline_score:.2f}")
+            with self._lock:
+                self.rejected.append(policy._replace(path=None))
+            return None
+
+        # Only accepted networks are written, a rejected one must not end up under a versioned file name
+        torch.save(candidate_weights, policy.path)
+        logger.info(f"Published network v{version}, holdout reward {score:.2f} (current {baseline_score:.2f})")
+        with self._lock:
+            self.latest = policy
+            self.published.append(policy)
+        return policy
+
+
+def train_candidate(env: LGBN_Env, config: TrainingConfig, baseline_weights, training_rounds):
+    """Trains a candidate from the baseline weights; returns its weights and the holdout scores of both networks."""
+    df = agent_utils.load_lgbn_data(config.lgbn_source, last_hours=config.last_hours)
+    train_df, holdout_df = split_holdout(df, config.holdout)
+    if len(holdout_df) < MIN_HOLDOUT_ROWS:
+        logger.info(f"Only {len(holdout_df)} holdout rows, postponing background training")
+        return None
+
+    candidate = DQN(state_dim=config.state_dim, action_dim=config.action_dim, force_restart=True,
+                    neurons=config.neurons, nn_folder=config.nn_folder, forgetting=config.forgetting)
+    candidate.env = env
+    candidate.Q.load_state_dict(baseline_weights)
+    candidate.Q_target.load_state_dict(baseline_weights)
+    candidate.training_rounds = training_rounds
+    candidate.plot_scores = False
+    candidate.store_networks = False
+
+    if candidate.train_dqn_from_vec_env(train_df, num_envs=config.num_envs) is None:
+        return None
+
+    candidate_weights = copy.deepcopy(candidate.Q.state_dict())
+
+    validation_sampler = build_holdout_sampler(holdout_df)
+    score = evaluate_policy(candidate, validation_sampler)
+    candidate.swap_network(baseline_weights)
+    baseline_score = evaluate_policy(candidate, validation_sampler)
+    return candidate_weights, score, baseline_score
+
+
+# Env of the training worker process, kept across rounds like TrainingService.env
+_worker_env = None
+
+
+def train_candidate_in_worker(config: TrainingConfig, baseline_weights, training_rounds):
+    global _worker_env
+    if _worker_env is None:
+        _worker_env = LGBN_Env()
+    return train_candidate(_worker_env, config, baseline_weights, training_rounds)
+
+
+def split_holdout(df, share):
+    # The most recent rows are held out, the network must generalize to where the service is heading
+    split = int(len(df) * (1 - share))
+    return df.iloc[:split], df.iloc[split:]
+
+
+def build_holdout_sampler(holdout_df):
+    env = LGBN_Env()
+    env.reload_lgbn_model(holdout_df)
+    return env.sampler
+
+
+def evaluate_policy(dqn: DQN, sampler, num_envs=VALIDATION_ENVS, steps=VALIDATION_STEPS, seed=0):
+    # Greedy rollouts from a fixed seed, so that two networks are scored on the same start states and noise
+    vec_env = VectorLGBN_Env(sampler, num_envs, rng=np.random.default_rng(seed))
+    states = vec_env.reset()
+    total = np.zeros(num_envs)
+    for _ in range(steps):
+        states, rewards = vec_env.step(dqn.choose_actions(states, rand=0.0))
+        total += rewards
+    return float(np.average(total))
@@ -0,0 +1,69 @@
+import numpy as np
+
+from agent.LGBN_Env import LGBNSampler
+from slo_config import calculate_slo_reward_batch, PW_MAX_CORES, Full_State
+
+
+class VectorLGBN_Env:
+    """K independent copies of LGBN_Env whose states are kept as arrays and stepped in one call."""
+
+    def __init__(self, sampler: LGBNSampler, num_envs, rng=None):
+        self.sampler = sampler
+        self.num_envs = num_envs
+        self.rng = rng if rng is not None else np.random.default_rng()
+
+        self.pixel = np.zeros(num_envs, dtype=np.int64)
+        self.pixel_thresh = np.zeros(num_envs, dtype=np.int64)
+        self.fps = np.zeros(num_envs, dtype=np.float64)
+        self.fps_thresh = np.zeros(num_envs, dtype=np.int64)
+        self.energy = np.zeros(num_envs, dtype=np.int64)
+        self.cores = np.zeros(num_envs, dtype=np.int64)
+        self.free_cores = np.zeros(num_envs, dtype=np.int64)
+
+    def reset(self):
+        n = self.num_envs
+        # Same distributions as LGBN_Env.reset, including the inclusive upper bounds of randint
+        self.pixel = self.rng.integers(1, 21, n) * 100
+        self.cores = self.rng.integers(1, PW_MAX_CORES + 1, n)
+        self.free_cores = PW_MAX_CORES - self.cores - self.rng.integers(0, PW_MAX_CORES - self.cores + 1)
+        self.fps, self.energy = self._sample()
+        self.pixel_thresh = self.rng.integers(5, 13, n) * 100
+        self.fps_thresh = self.rng.integers(20, 41, n)
+        return self.for_tensor()
+
+    def _sample(self):
+        fps, energy = self.sampler.sample(self.pixel, self.cores, rng=self.rng)
+        return fps, np.trunc(energy).astype(np.int64)
+
+    def step(self, actions: np.ndarray):
+        actions = np.asarray(actions)
+        punishment = np.zeros(self.num_envs)
+
+        # Pixel: 1 lowers and 2 raises by 100, but nothing moves at the borders of the range
+        pixel_action = (actions == 1) | (actions == 2)
+        pixel_blocked = pixel_action & ((self.pixel == 100) | (self.pixel >= 2000))
+        punishment[pixel_blocked] = -5
+        self.pixel = self.pixel + np.where(pixel_action & ~pixel_blocked, np.where(actions == 1, -100, 100), 0)
+
+        # Cores: 3 releases and 4 claims a core, as long as at least one stays and a free one exists
+        core_delta = np.where(actions == 3, -1, np.where(actions == 4, 1, 0))
+        cores_blocked = ((core_delta == -1) & (self.cores == 1)) | ((core_delta == 1) & (self.free_cores <= 0))
+        punishment[cores_blocked] = -10
+        core_delta[cores_blocked] = 0
+        self.cores = self.cores + core_delta
+        self.free_cores = self.free_cores - core_delta
+
+        self.fps, self.energy = self._sample()
+        state = self.for_tensor()
+
+        reward = calculate_slo_reward_batch(state).sum(axis=1) + punishment
+        return state, reward
+
+    def for_tensor(self) -> np.ndarray:
+        return np.column_stack([self.pixel / self.pixel_thresh, self.fps / self.fps_thresh, self.cores,
+                                self.pixel > 100, self.pixel < 2000, self.free_cores > 0]).astype(np.float64)
+
+    def get_state(self, index) -> Full_State:
+        return Full_State(int(self.pixel[index]), int(self.pixel_thresh[index]), float(self.fps[index]),
+                          int(self.fps_thresh[index]), int(self.energy[index]), int(self.cores[index]),
+                          int(self.free_cores[index]))
@@ -1,4 +1,3 @@
-import csv
 import logging
 import os
 import time
@@ -11,10 +10,15 @@ from matplotlib import pyplot as plt
 from pgmpy.models import LinearGaussianBayesianNetwork
 from pgmpy.readwrite import XMLBIFWriter
 
+import utils
 from slo_config import PW_MAX_CORES, Full_State
 
 logger = logging.getLogger('multiscale')
 
+LGBN_EDGES = [('pixel', 'fps'), ('cores', 'fps'), ('cores', 'energy'), ('pixel', 'energy')]
+SLO_F_HEADER = ["index", "rep", "timestamp", "pixel", "pixel_thresh", "fps", "fps_thresh", "energy", "cores",
+                "free_cores"]
+
 
 def print_execution_time(func):
     def wrapper(*args, **kwargs):
@@ -29,11 +33,26 @@ def print_execution_time(func):
     return wrapper
 
 
+def load_lgbn_data(source, last_hours=None) -> pd.DataFrame:
+    # Directories are Parquet experience stores, everything else is treated as the plain LGBN.csv
+    if os.path.isdir(source):
+        from agent.ExperienceStore import ExperienceStore
+        return ExperienceStore(source).load(last_hours=last_hours)
+
+    # Rows that CsvMetricsWriter rotated into timestamped files come first, so the history stays in order
+    since = datetime.now() - pd.Timedelta(hours=last_hours) if last_hours is not None else None
+    files = utils.rotated_files(source, since) or [source]
+    df = pd.concat([pd.read_csv(file) for file in files], ignore_index=True)
+    if since is not None:
+        df = df[pd.to_datetime(df['timestamp']) >= since]
+    return df
+
+
 # @print_execution_time # Roughly 1 to 1.5s
-def train_lgbn_model(df, show_result=False):
-    df_filtered = filter_3s_after_change(df.copy())
+def train_lgbn_model(df, show_result=False, settle_s=3.0):
+    df_filtered = filter_3s_after_change(df.copy(), settle_s)
 
-    model = LinearGaussianBayesianNetwork([('pixel', 'fps'), ('cores', 'fps'), ('cores', 'energy'), ('pixel', 'energy')])
+    model = LinearGaussianBayesianNetwork(LGBN_EDGES)
     # XMLBIFWriter(model).write_xmlbif("../model.xml")
     model.fit(df_filtered)
 
@@ -51,18 +70,19 @@ def train_lgbn_model(df, show_result=False):
     return model
 
 
-# @utils.print_execution_time # Recently almost 500ms
-def filter_3s_after_change(df: pd.DataFrame):
+def filter_3s_after_change(df: pd.DataFrame, settle_s=3.0):
     df['timestamp'] = pd.to_datetime(df['timestamp'])
+    timestamps = df['timestamp'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
 
-    # Identify timestamps where the flag is True
-    flagged_times = df.loc[df['change_flag'], 'timestamp']
-
-    # Add a 3-second range for each flagged timestamp
-    mask = pd.Series(False, index=df.index)
+    # Sorted timestamps where the flag is True
+    flagged_times = np.sort(timestamps[df['change_flag'].to_numpy(dtype=bool)])
+    if len(flagged_times) == 0:
+        return df
 
-    for t in flagged_times:
-        mask |= (df['timestamp'] >= t) & (df['timestamp'] <= t + pd.Timedelta(seconds=3))
+    # A row lies in a settle window iff the latest change at or before it happened at most settle_s earlier
+    latest_change = np.searchsorted(flagged_times, timestamps, side='right') - 1
+    delta = timestamps - flagged_times[np.maximum(latest_change, 0)]
+    mask = (latest_change >= 0) & (delta <= int(settle_s * 1e9))
 
     filtered_df = df[~mask]
     return filtered_df
@@ -80,19 +100,6 @@ def was_qn_ever_trained(qn):
     return qn.last_time_trained != datetime(1970, 1, 1, 0, 0, 0)
 
 
-def log_agent_experience(state: Full_State, prefix):
-    # Define the directory and file name
-    directory = "./"
-    file_name = "slo_f.csv"
-    file_path = os.path.join(directory, file_name)
-
-    file_exists = os.path.isfile(file_path)
-
-    # Open the file in append mode
-    with open(file_path, mode='a', newline='') as file:
-        writer = csv.writer(file)
-
-        if not file_exists or os.path.getsize(file_path) == 0:
-            writer.writerow(["index", "rep", "timestamp", "pixel", "pixel_thresh", "fps", "fps_thresh", "energy", "cores", "free_cores"])
-
-        writer.writerow([prefix[0], prefix[1], datetime.now()] +  list(state))
+def log_agent_experience(state: Full_State, prefix, timestamp=None):
+    writer = utils.get_metrics_writer(os.path.join("./", "slo_f.csv"), SLO_F_HEADER)
+    writer.write([prefix[0], prefix[1], timestamp or datetime.now()] + list(state))
@@ -0,0 +1,71 @@
+import asyncio
+import threading
+import time
+
+from aiohttp import web
+
+from HttpClient import HttpClient, SyncControlClient
+
+# Run from the repository root with: python -m benchmarks.control_fanout
+SERVICES = 50
+HANDLING_S = 0.02  # What a service needs to apply a change
+BASE_PORT = 18100
+
+
+async def handle_change(request):
+    await asyncio.sleep(HANDLING_S)
+    return web.Response(text="")
+
+
+async def handle_reconfigure(request):
+    await request.json()
+    await asyncio.sleep(HANDLING_S)
+    return web.json_response({"apply_ms": HANDLING_S * 1000.0})
+
+
+def serve_fleet(loop):
+    # Every fake service listens on its own port, like one container per address
+    asyncio.set_event_loop(loop)
+    app = web.Application()
+    app.add_routes([web.put("/change_config", handle_change), web.put("/change_threads", handle_change),
+                    web.put("/reconfigure", handle_reconfigure)])
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    for i in range(SERVICES):
+        loop.run_until_complete(web.TCPSite(runner, "127.0.0.1", BASE_PORT + i).start())
+    loop.run_forever()
+
+
+def targets():
+    return [f"127.0.0.1:{BASE_PORT + i}" for i in range(SERVICES)]
+
+
+def run_sequential():
+    client = HttpClient()
+    for target in targets():
+        host, port = target.split(":")
+        client.PORT = int(port)
+        client.change_config(host, {'pixel': 800})
+        client.change_threads(host, 4)
+
+
+def run_fan_out(client):
+    results = client.reset_all({target: (800, 4) for target in targets()})
+    return max(result.latency_s for result in results), sum(result.error is not None for result in results)
+
+
+if __name__ == '__main__':
+    threading.Thread(target=serve_fleet, args=(asyncio.new_event_loop(),), daemon=True).start()
+    time.sleep(1.0)
+
+    start = time.perf_counter()
+    run_sequential()
+    print(f"{'sequential requests':>22}: {(time.perf_counter() - start) * 1000:7.1f} ms for {SERVICES} services")
+
+    control_client = SyncControlClient()
+    for label in ["async fan-out (cold)", "async fan-out (warm)"]:
+        start = time.perf_counter()
+        slowest, errors = run_fan_out(control_client)
+        print(f"{label:>22}: {(time.perf_counter() - start) * 1000:7.1f} ms for {SERVICES} services, "
+              f"slowest target {slowest * 1000:.1f} ms, {errors} errors")
+    control_client.close()
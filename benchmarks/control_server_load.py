@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import os
+import threading
+import time
+
+import aiohttp
+import cv2
+import numpy as np
+
+from HttpServer import create_app, start_control_server
+from Telemetry import TelemetryHub
+
+# Run from the repository root with: python -m benchmarks.control_server_load [--detector]
+PORT = 18200
+REQUESTS = 2000
+CONCURRENCY = 1  # The agents send one change at a time per service
+WORKERS_PER_CORE = 4  # Same as the detector's thread multiplier
+
+
+class StubDetector:
+    # Mirrors the QrDetector methods the control server calls, without video, pyzbar or Docker
+    def __init__(self):
+        self.service_conf = {'pixel': 800}
+        self.cores = 2
+        self.thread_multiplier = 4
+        self.telemetry = TelemetryHub()
+
+    def change_threads(self, c_threads):
+        self.cores = c_threads
+
+    def reconfigure(self, pixel=None, cores=None, thread_multiplier=None):
+        start = time.perf_counter()
+        self.service_conf = self.service_conf | ({'pixel': pixel} if pixel else {})
+        self.cores = cores or self.cores
+        self.thread_multiplier = thread_multiplier or self.thread_multiplier
+        return (time.perf_counter() - start) * 1000.0
+
+
+class StubDocker:
+    def update_cpu_async(self, container_ref, cpus):
+        pass
+
+
+def saturate_cores(stop: threading.Event):
+    # Frame-like work: OpenCV releases the GIL like the real decode path, one thread also spins in Python
+    frame = np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8)
+
+    def opencv_worker():
+        while not stop.is_set():
+            gray = cv2.cvtColor(cv2.resize(frame, (1422, 800)), cv2.COLOR_BGR2GRAY)
+            cv2.GaussianBlur(gray, (9, 9), 0)
+
+    def python_worker():
+        counter = 0
+        while not stop.is_set():
+            counter += 1
+
+    threads = [threading.Thread(target=opencv_worker, daemon=True) for _ in range(os.cpu_count() * WORKERS_PER_CORE)]
+    threads.append(threading.Thread(target=python_worker, daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+async def load_test():
+    handling_ms, round_trip_ms = [], []
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async with aiohttp.ClientSession() as session:
+        async def reconfigure(i):
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.put(f"http://127.0.0.1:{PORT}/reconfigure", json={"pixel": 100 + i % 20 * 100,
+                                                                                   "cores": 1 + i % 4}) as response:
+                    await response.read()
+                    response.raise_for_status()
+                round_trip_ms.append((time.perf_counter() - start) * 1000.0)
+                handling_ms.append(float(response.headers["Server-Timing"].split("dur=")[1]))
+
+        await asyncio.gather(*[reconfigure(i) for i in range(REQUESTS)])
+    return np.array(handling_ms), np.array(round_trip_ms)
+
+
+def report(label, handling_ms, round_trip_ms):
+    print(f"{label:>10}: handling p50 {np.percentile(handling_ms, 50):.3f} ms, "
+          f"p99 {np.percentile(handling_ms, 99):.3f} ms | round trip p50 {np.percentile(round_trip_ms, 50):.2f} ms, "
+          f"p99 {np.percentile(round_trip_ms, 99):.2f} ms")
+
+
+def run_with_stub():
+    start_control_server(create_app(StubDetector(), StubDocker()), host="127.0.0.1", port=PORT)
+    report("idle", *asyncio.run(load_test()))
+
+    stop_event = threading.Event()
+    load_threads = saturate_cores(stop_event)
+    time.sleep(1.0)
+    report("saturated", *asyncio.run(load_test()))
+
+    stop_event.set()
+    for load_thread in load_threads:
+        load_thread.join()
+
+
+def run_with_detector():
+    # The real detector decoding the looping video in the same process; needs pyzbar and Docker like the service.
+    # Only the quota updates are stubbed, the requests would otherwise resize the container running the benchmark
+    from QrDetector import QrDetector
+
+    detector = QrDetector()
+    start_control_server(create_app(detector, StubDocker()), host="127.0.0.1", port=PORT)
+    report("idle", *asyncio.run(load_test()))
+
+    detector.start_process()
+    time.sleep(2.0)
+    report("processing", *asyncio.run(load_test()))
+    print(f"Detector at {detector.fps.get_current_fps():.1f} FPS with up to {detector.number_threads} threads")
+    detector.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Latency of /reconfigure while the service is busy")
+    parser.add_argument("--detector", action="store_true", help="load a real QrDetector instead of a stub")
+    if parser.parse_args().detector:
+        run_with_detector()
+    else:
+        run_with_stub()
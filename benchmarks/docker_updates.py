@@ -0,0 +1,94 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import docker
+
+from DockerClient import DockerClient
+
+# Run from the repository root with: python -m benchmarks.docker_updates
+API_LATENCY_S = 0.02  # Roughly what a local dockerd needs per call
+CONTAINER_REF = "multiscaler-video-processing-a-1"
+CONTAINER_ID = "4f1c0ffee0ddba11"
+UPDATES = 50
+
+
+class FakeDockerApi(BaseHTTPRequestHandler):
+    """Answers the handful of Engine API calls that DockerClient issues."""
+    calls = {"inspect": 0, "update": 0}
+
+    def _reply(self, body):
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        time.sleep(API_LATENCY_S)
+        if self.path.endswith("/version"):
+            self._reply({"ApiVersion": "1.45", "Version": "fake"})
+        elif re.search(r"/containers/[^/]+/json", self.path):
+            FakeDockerApi.calls["inspect"] += 1
+            self._reply({"Id": CONTAINER_ID, "Name": "/" + CONTAINER_REF})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(API_LATENCY_S)
+        if re.search(r"/containers/[^/]+/update", self.path):
+            FakeDockerApi.calls["update"] += 1
+            self._reply({"Warnings": []})
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def reset_calls():
+    FakeDockerApi.calls = {"inspect": 0, "update": 0}
+
+
+def run_uncached(url):
+    # What update_cpu did before: resolve the container on every call, then update synchronously
+    client = docker.DockerClient(base_url=url)
+    for cpus in range(UPDATES):
+        client.containers.get(CONTAINER_REF).update(cpu_quota=(cpus % 10 + 1) * 100000)
+
+
+def run_cached(url):
+    client = DockerClient(url)
+    for cpus in range(UPDATES):
+        client.update_cpu(CONTAINER_REF, cpus % 10 + 1)
+
+
+def run_async(url):
+    client = DockerClient(url)
+    futures = [client.update_cpu_async(CONTAINER_REF, cpus % 10 + 1) for cpus in range(UPDATES)]
+    blocked = time.perf_counter()
+    for future in futures:
+        future.result()
+    return blocked
+
+
+if __name__ == '__main__':
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeDockerApi)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"tcp://127.0.0.1:{server.server_address[1]}"
+
+    for name, routine in [("uncached sync", run_uncached), ("cached sync", run_cached), ("async coalesced", run_async)]:
+        reset_calls()
+        start = time.perf_counter()
+        blocked_until = routine(url)
+        total_ms = (time.perf_counter() - start) * 1000.0
+        blocked_ms = (blocked_until - start) * 1000.0 if blocked_until else total_ms
+        print(f"{name:>16}: caller blocked {blocked_ms:7.1f} ms, all applied after {total_ms:7.1f} ms, "
+              f"{FakeDockerApi.calls['inspect']} inspects / {FakeDockerApi.calls['update']} updates "
+              f"for {UPDATES} changes")
+
+    server.shutdown()
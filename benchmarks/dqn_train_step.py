@@ -0,0 +1,64 @@
+import time
+
+import numpy as np
+import torch
+
+from agent.DQN import DQN, STATE_DIM
+
+# Run from the repository root with: python -m benchmarks.dqn_train_step
+STEPS = 2000
+WARMUP = 50
+
+
+def soft_update_loop(dqn):
+    # Former Polyak update, one Python iteration and three temporaries per parameter tensor
+    for param_target, param in zip(dqn.Q_target.parameters(), dqn.Q.parameters()):
+        param_target.data.copy_(param_target.data * (1.0 - dqn.tau) + param.data * dqn.tau)
+
+
+def train_batch_legacy(dqn):
+    mini_batch = dqn.memory.sample(dqn.batch_size)
+    s_batch, a_batch, _, _, _ = mini_batch
+    td_target = dqn.calc_target(mini_batch)
+    q_loss = torch.nn.functional.smooth_l1_loss(dqn.Q(s_batch).gather(1, a_batch), td_target)
+    dqn.Q.optimizer.zero_grad()
+    q_loss.mean().backward()
+    dqn.Q.optimizer.step()
+    soft_update_loop(dqn)
+
+
+def fill_memory(dqn, n=10_000):
+    rng = np.random.default_rng(0)
+    dqn.memory.put_batch(rng.random((n, STATE_DIM)), rng.integers(0, 5, n), rng.random(n),
+                         rng.random((n, STATE_DIM)), np.zeros(n, dtype=bool))
+
+
+def steps_per_second(train_step, dqn):
+    for _ in range(WARMUP):
+        train_step(dqn)
+    start = time.perf_counter()
+    for _ in range(STEPS):
+        train_step(dqn)
+    return STEPS / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    results = []
+
+    torch.autograd.set_detect_anomaly(True)
+    dqn = DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True)
+    fill_memory(dqn)
+    results.append(("before: loop update, anomaly on", steps_per_second(train_batch_legacy, dqn)))
+
+    torch.autograd.set_detect_anomaly(False)
+    results.append(("foreach update, anomaly off", steps_per_second(DQN.train_batch, dqn)))
+
+    try:
+        compiled = DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True, compile_network=True)
+        fill_memory(compiled)
+        results.append(("+ torch.compile", steps_per_second(DQN.train_batch, compiled)))
+    except Exception as e:
+        print(f"torch.compile not available here: {e}")
+
+    for name, rate in results:
+        print(f"{name:>32} | {rate:8.0f} steps/s")
@@ -0,0 +1,44 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from agent.DQN import DQN, STATE_DIM
+from agent.LGBN_Env import LGBN_Env
+from agent.VectorLGBN_Env import VectorLGBN_Env
+
+# Run from the repository root with: python -m benchmarks.dqn_vector_env
+LGBN_FILE = "results/E1/LGBN.csv"
+ENV_STEPS = 20_000
+NUM_ENVS = [1, 16, 256, 4096]
+
+
+def rollout_single(dqn, env):
+    env.reset()
+    start = time.perf_counter()
+    for _ in range(ENV_STEPS):
+        action = dqn.choose_action(np.array(env.state.for_tensor()))
+        env.step(action)
+    return ENV_STEPS / (time.perf_counter() - start)
+
+
+def rollout_vector(dqn, env, num_envs):
+    vec_env = VectorLGBN_Env(env.sampler, num_envs)
+    states = vec_env.reset()
+    steps = max(1, ENV_STEPS // num_envs)
+    start = time.perf_counter()
+    for _ in range(steps):
+        states, _ = vec_env.step(dqn.choose_actions(states))
+    return steps * num_envs / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    env = LGBN_Env()
+    env.reload_lgbn_model(pd.read_csv(LGBN_FILE))
+    dqn = DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True)
+    dqn.epsilon = 0.1
+
+    print(f"{'setup':>16} | {'env-steps/s':>12}")
+    print(f"{'LGBN_Env':>16} | {rollout_single(dqn, env):>12.0f}")
+    for k in NUM_ENVS:
+        print(f"{f'VectorEnv K={k}':>16} | {rollout_vector(dqn, env, k):>12.0f}")
@@ -0,0 +1,93 @@
+import concurrent.futures
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import QrWorker
+from slo_config import PW_MAX_CORES
+
+# Run from the repository root with: python -m benchmarks.executor_scaling
+ROOT = os.path.dirname(os.path.dirname(__file__))
+VIDEO_PATH = ROOT + "/data/QR_Video.mp4"
+THREAD_MULTIPLIER = 4
+DURATION_S = 5
+PIXEL = 800
+# CPUs available at start-up, e.g., the cpuset of the container; limits are always a subset of these
+ORIGINAL_AFFINITY = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None
+
+
+def load_frames(number=30):
+    # Decoding is done upfront, otherwise the benchmark would measure ffmpeg instead of the executor
+    vcap = cv2.VideoCapture(VIDEO_PATH)
+    frames = []
+    while len(frames) < number:
+        grabbed, frame = vcap.read()
+        if not grabbed:
+            break
+        frames.append(frame)
+    vcap.release()
+    return frames
+
+
+def limit_to_cores(cores):
+    # Emulates the Docker CPU quota; worker processes inherit the affinity
+    if ORIGINAL_AFFINITY is not None:
+        os.sched_setaffinity(0, ORIGINAL_AFFINITY[:cores])
+
+
+def measure_fps(backend, cores, frames):
+    config = {'pixel': PIXEL}
+    in_flight = cores * THREAD_MULTIPLIER
+    arena = None
+
+    if backend == "thread":
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=in_flight)
+    else:
+        arena = QrWorker.SharedFrameArena(in_flight, frames[0].shape)
+        # Spawned like in QrDetector, the warm-up below keeps the slower start-up out of the measurement
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=cores,
+                                                          mp_context=multiprocessing.get_context("spawn"),
+                                                          initializer=QrWorker.attach_arena,
+                                                          initargs=arena.descriptor())
+
+    def submit(frame):
+        if arena is None:
+            return executor.submit(QrWorker.decode_frame, frame, config)
+        slot = arena.put(frame)
+        future = executor.submit(QrWorker.decode_arena_slot, slot, frame.shape, config)
+        future.add_done_callback(lambda _: arena.release(slot))
+        return future
+
+    processed, index = 0, 0
+    with executor:
+        # Warm up the workers so process start-up is not part of the measurement
+        concurrent.futures.wait([submit(frames[i % len(frames)]) for i in range(in_flight)])
+
+        start = time.perf_counter()
+        while time.perf_counter() - start < DURATION_S:
+            batch = [submit(frames[(index + i) % len(frames)]) for i in range(in_flight)]
+            index += in_flight
+            concurrent.futures.wait(batch)
+            processed += len(batch)
+        elapsed = time.perf_counter() - start
+
+    if arena is not None:
+        arena.close()
+    return processed / elapsed
+
+
+if __name__ == '__main__':
+    frames = load_frames()
+    max_cores = min(PW_MAX_CORES, len(ORIGINAL_AFFINITY) if ORIGINAL_AFFINITY is not None else os.cpu_count())
+
+    print(f"{'cores':>5} | {'thread FPS':>10} | {'process FPS':>11}")
+    for cores in range(1, max_cores + 1):
+        limit_to_cores(cores)
+        fps_thread = measure_fps("thread", cores, frames)
+        fps_process = measure_fps("process", cores, frames)
+        print(f"{cores:>5} | {fps_thread:>10.1f} | {fps_process:>11.1f}")
+
+    if ORIGINAL_AFFINITY is not None:
+        os.sched_setaffinity(0, ORIGINAL_AFFINITY)
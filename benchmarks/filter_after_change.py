@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from agent.agent_utils import filter_3s_after_change
+
+# Run from the repository root with: python -m benchmarks.filter_after_change
+ROW_COUNTS = [10_000, 100_000, 1_000_000, 10_000_000]
+FLAG_RATE = 0.01  # Share of rows that follow a configuration change
+LOOP_LIMIT = 100_000  # The previous implementation is O(flags x rows), larger sizes take minutes
+
+
+def synthetic_metrics(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    # Rows arrive every ~250ms like the QrDetector report loop
+    offsets = np.cumsum(rng.uniform(0.2, 0.3, rows))
+    return pd.DataFrame({'timestamp': pd.Timestamp("2024-11-30") + pd.to_timedelta(offsets, unit="s"),
+                         'fps': rng.integers(5, 60, rows),
+                         'change_flag': rng.random(rows) < FLAG_RATE})
+
+
+def filter_loop(df: pd.DataFrame, settle_s=3.0):
+    # Former implementation, kept as reference for correctness and timing
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    flagged_times = df.loc[df['change_flag'], 'timestamp']
+    mask = pd.Series(False, index=df.index)
+    for t in flagged_times:
+        mask |= (df['timestamp'] >= t) & (df['timestamp'] <= t + pd.Timedelta(seconds=settle_s))
+    return df[~mask]
+
+
+def time_ms(function, df):
+    start = time.perf_counter()
+    result = function(df.copy())
+    return (time.perf_counter() - start) * 1000.0, result
+
+
+if __name__ == '__main__':
+    print(f"{'rows':>10} | {'loop ms':>9} | {'searchsorted ms':>15}")
+    for rows in ROW_COUNTS:
+        df = synthetic_metrics(rows)
+        vectorized_ms, vectorized = time_ms(filter_3s_after_change, df)
+
+        loop_col = "-"
+        if rows <= LOOP_LIMIT:
+            loop_ms, looped = time_ms(filter_loop, df)
+            assert looped.index.equals(vectorized.index)
+            loop_col = f"{loop_ms:.1f}"
+
+        print(f"{rows:>10} | {loop_col:>9} | {vectorized_ms:>15.1f}")
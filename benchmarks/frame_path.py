@@ -0,0 +1,44 @@
+import time
+
+import cv2
+import numpy as np
+from pyzbar.pyzbar import decode
+
+import QrWorker
+import utils
+from benchmarks.executor_scaling import load_frames
+
+# Run from the repository root with: python -m benchmarks.frame_path
+ITERATIONS = 300
+PIXELS = [200, 400, 600, 800, 1400]
+
+
+def decode_frame_before(frame, config_params):
+    # Former path: resize the color frame, convert it, decode and always draw the annotations
+    target_height = int(config_params['pixel'])
+    original_width, original_height = frame.shape[1], frame.shape[0]
+    ratio = original_height / target_height
+    frame = cv2.resize(frame, (int(original_width / ratio), int(original_height / ratio)))
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    utils.highlight_qr_codes(frame, decode(gray))
+
+
+def measure(routine, frames, config):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        routine(frames[i % len(frames)], config)
+    return (time.perf_counter() - start) * 1000.0 / ITERATIONS
+
+
+if __name__ == '__main__':
+    frames = load_frames()
+    print(f"Frames of {frames[0].shape[1]}x{frames[0].shape[0]}, {ITERATIONS} iterations per row")
+    stage_header = " | ".join(f"{stage:>8}" for stage in QrWorker.STAGES)
+    print(f"{'pixel':>5} | {'before ms':>9} | {'after ms':>8} | {stage_header}")
+
+    for pixel in PIXELS:
+        config = {'pixel': pixel}
+        before = measure(decode_frame_before, frames, config)
+        after = measure(QrWorker.decode_frame, frames, config)
+        stages = np.average([QrWorker.decode_frame(frames[i % len(frames)], config) for i in range(50)], axis=0)
+        print(f"{pixel:>5} | {before:>9.2f} | {after:>8.2f} | " + " | ".join(f"{ms:>8.2f}" for ms in stages))
@@ -0,0 +1,53 @@
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import QrWorker
+from VideoReader import VideoReader
+
+# Run from the repository root with: python -m benchmarks.video_cache
+FRAMES = 600  # A bit more than two passes over the video
+PIXEL = 720
+
+
+def measure_reader(**kwargs):
+    # Frames per second the reader delivers to a consumer that does nothing else, decoding at PIXEL
+    reader = VideoReader(buffer_size=16, **kwargs)
+    reader.select_pixel(PIXEL)
+    reader.start()
+    start = time.perf_counter()
+    for _ in range(FRAMES):
+        reader.read(timeout=5.0)
+    fps = FRAMES / (time.perf_counter() - start)
+    reader.stop()
+    return fps
+
+
+def measure_decode(reader, iterations=200):
+    reader.select_pixel(PIXEL)
+    reader.start()
+    frames = [reader.read(timeout=5.0) for _ in range(30)]
+    reader.stop()
+    times = [sum(QrWorker.decode_frame(frames[i % len(frames)], {'pixel': PIXEL})) for i in range(iterations)]
+    return float(np.average(times))
+
+
+if __name__ == '__main__':
+    cache_dir = tempfile.mkdtemp()
+    try:
+        print(f"{FRAMES} frames per row")
+        print(f"decoding every pass         {measure_reader():>8.1f} fps")
+        print(f"cache, first run            {measure_reader(cache=True, cache_dir=cache_dir):>8.1f} fps")
+        print(f"cache, later run            {measure_reader(cache=True, cache_dir=cache_dir):>8.1f} fps")
+        print(f"cache at {PIXEL}p, first run   "
+              f"{measure_reader(cache=True, cache_dir=cache_dir, cache_pixel=PIXEL):>8.1f} fps")
+        print(f"cache at {PIXEL}p, later run   "
+              f"{measure_reader(cache=True, cache_dir=cache_dir, cache_pixel=PIXEL):>8.1f} fps")
+
+        full = measure_decode(VideoReader(cache=True, cache_dir=cache_dir))
+        scaled = measure_decode(VideoReader(cache=True, cache_dir=cache_dir, cache_pixel=PIXEL))
+        print(f"decode_frame at {PIXEL}p: {full:.2f} ms from full frames, {scaled:.2f} ms from pre-scaled frames")
+    finally:
+        shutil.rmtree(cache_dir)
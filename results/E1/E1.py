@@ -7,10 +7,12 @@ import pandas as pd
 from matplotlib import pyplot as plt
 
 from DockerClient import DockerInfo
-from HttpClient import HttpClient
+from HttpClient import get_control_client
 from agent.BaseAgent import BaseAgent
 from agent.DQN import DQN, STATE_DIM
 from agent.ScalingAgent_v2 import ScalingAgent, reset_core_states
+from agent.Simulation import Simulation, replay_routine
+from agent.TrainingRunner import partition_jobs, run_jobs
 from slo_config import PW_MAX_CORES, Full_State, calculate_slo_reward
 
 plt.rcParams.update({'font.size': 12})
@@ -20,7 +22,6 @@ routine_file = "test_routine.csv"
 reps = 5
 partitions = 5
 container = DockerInfo("multiscaler-video-processing-a-1", "172.18.0.4", "Alice")
-http_client = HttpClient()
 p_s = "http://172.18.0.2:9090"
 
 
@@ -31,13 +32,9 @@ def train_networks():
     df_size = len(df)
     end_indices = [166, 262, int(df_size * 3 / 5), int(df_size * 4 / 5), df_size]
 
-    for i, val in enumerate(end_indices):
-        partition_df = df.iloc[:val]
-
-        dqn = DQN(state_dim=STATE_DIM, action_dim=5, force_restart=True, nn_folder=nn)
-        dqn.train_dqn_from_env(df=partition_df, suffix=f"{i + 1}")
-
-        print(f"{((i + 1) / partitions) * 100}% finished")
+    # All partitions train side by side, each in its own process; scores and model files end up in nn/index.csv
+    index = run_jobs(partition_jobs(file_path, end_indices), nn)
+    print(index.drop(columns="scores", errors="ignore").to_string())
 
 
 def eval_networks():
@@ -81,6 +78,29 @@ def eval_baseline():
             print(f"{(((i * partitions) + j) / (reps * partitions)) * 100}% finished")
 
 
+def simulate_networks(seed=0):
+    # Same routine as eval_networks, but against the LGBN instead of the container; takes seconds, not minutes
+    simulation = Simulation("LGBN.csv", seed)
+
+    def create_agent(i, j, thresholds, max_cores):
+        dqn = DQN(state_dim=STATE_DIM, action_dim=5, nn_folder=nn, suffix=f"{i}")
+        return ScalingAgent(container=container, prom_server=p_s, thresholds=thresholds, dqn=dqn, log=(i, j),
+                            max_cores=max_cores, **simulation.clients())
+
+    replay_routine(simulation, routine_file, container, create_agent)
+
+
+def simulate_baseline(seed=0):
+    simulation = Simulation("LGBN.csv", seed)
+
+    def create_agent(i, j, thresholds, max_cores):
+        return BaseAgent(container=container, prom_server=p_s, thresholds=thresholds, log=(i, j),
+                         max_cores=max_cores, **simulation.clients())
+
+    # eval_baseline starts every row from the pixel threshold and settles for 1 s only
+    replay_routine(simulation, routine_file, container, create_agent, settle_s=1, start_pixel_t=True)
+
+
 def create_test_routine():
     runs = [["index", "rep", "pixel", "cores", "pixel_t", "fps_t", "max_cores"]]
     for i in range(1, partitions + 1):
@@ -101,8 +121,10 @@ def create_test_routine():
 
 
 def reset_container_params(c, pixel, cores):
-    http_client.change_config(c.ip_a, {'pixel': int(pixel)})
-    http_client.change_threads(c.ip_a, int(cores))
+    # Pixel and threads change in a single /reconfigure request; failures still abort the experiment like before
+    for result in get_control_client().reset_all({c.ip_a: (pixel, cores)}):
+        if result.error is not None:
+            raise result.error
 
 
 def visualize_data(slof_files, output_file):
@@ -178,4 +200,6 @@ if __name__ == '__main__':
     # create_test_routine()
     # eval_networks()
     # eval_baseline()
+    # simulate_networks()
+    # simulate_baseline()
     visualize_data(["slo_f_meth.csv", "slo_f_base.csv"], "./plots/tight_constraints_comparison.png")
@@ -1,3 +1,4 @@
+import logging
 import time
 
 import numpy as np
@@ -5,18 +6,20 @@ import pandas as pd
 from matplotlib import pyplot as plt
 
 from DockerClient import DockerInfo
-from HttpClient import HttpClient
+from HttpClient import get_control_client
 from agent.DQN import DQN, STATE_DIM
 from agent.Global_Service_Optimizer import Global_Service_Optimizer
 from agent.ScalingAgent_v2 import ScalingAgent, reset_core_states_2
+from agent.Simulation import Simulation, flush_experience
 from slo_config import Full_State, calculate_slo_reward
 
 plt.rcParams.update({'font.size': 12})
 
+logger = logging.getLogger("multiscale")
+
 container_1 = DockerInfo("multiscaler-video-processing-a-1", "172.18.0.4", "Alice")
 container_2 = DockerInfo("multiscaler-video-processing-b-1", "172.18.0.5", "Bob")
 p_s = "http://172.18.0.2:9090"
-http_client = HttpClient()
 
 nn = "./networks"
 changes = 10
@@ -24,51 +27,66 @@ changes = 10
 max_cores = 8
 starting_pixel, starting_cores = 1400, 2
 
-dqn = DQN(state_dim=STATE_DIM, action_dim=5, nn_folder=nn, suffix="5")
-agent_1 = ScalingAgent(container=container_1, prom_server=p_s, thresholds=(1300, 30),
-                       dqn=dqn, log=("Alice", None), max_cores=max_cores)
-agent_2 = ScalingAgent(container=container_2, prom_server=p_s, thresholds=(1300, 10),
-                       dqn=dqn, log=("Bob", None), max_cores=max_cores)
 
-glo = Global_Service_Optimizer(agents=[agent_1, agent_2])
+def create_agents(**clients):
+    # Clients are only passed for the simulation, otherwise the agents talk to the containers and Prometheus
+    dqn = DQN(state_dim=STATE_DIM, action_dim=5, nn_folder=nn, suffix="5")
+    a_1 = ScalingAgent(container=container_1, prom_server=p_s, thresholds=(1300, 30),
+                       dqn=dqn, log=("Alice", None), max_cores=max_cores, **clients)
+    a_2 = ScalingAgent(container=container_2, prom_server=p_s, thresholds=(1300, 10),
+                       dqn=dqn, log=("Bob", None), max_cores=max_cores, **clients)
+    return a_1, a_2, Global_Service_Optimizer(agents=[a_1, a_2])
 
 
-def reset_container_params(c, pixel, cores):
-    http_client.change_config(c.ip_a, {'pixel': int(pixel)})
-    http_client.change_threads(c.ip_a, int(cores))
+def reset_containers_params(params_by_container: dict):
+    # All containers are reset at the same time, so this takes as long as the slowest one
+    results = get_control_client().reset_all({c.ip_a: params for c, params in params_by_container.items()})
+    for result in results:
+        logger.info(f"Reset {result.target} in {result.latency_s * 1000:.1f} ms, applied in {result.apply_ms} ms")
+        if result.error is not None:
+            raise result.error
 
 
-def start_greedy_agents():
-    reset_container_params(container_1, starting_pixel, starting_cores)
-    reset_container_params(container_2, starting_pixel, starting_cores)
+def start_greedy_agents(agent_1, agent_2, reset=reset_containers_params, start=ScalingAgent.start, sleep=time.sleep):
+    reset({container_1: (starting_pixel, starting_cores), container_2: (starting_pixel, starting_cores)})
     reset_core_states_2([container_1, container_2], [starting_cores, starting_cores])
-    time.sleep(3)
+    sleep(3)
 
-    agent_1.start()
-    agent_2.start()
-    time.sleep(10)
+    start(agent_1)
+    start(agent_2)
+    sleep(10)
 
     while agent_1.has_free_cores():
         print("Still free cores available, waiting...")
-        time.sleep(5)
+        sleep(5)
 
     agent_1.set_idle(True)
     agent_2.set_idle(True)
 
 
-def improve_global_slof():
+def improve_global_slof(agent_1, agent_2, glo, sleep=time.sleep):
     for i in range(0, changes):
         if not agent_1.has_free_cores():
             estimates = glo.estimate_swapping()
             glo.swap_core(estimates)
 
         print(f"Finish iteration {i + 1} / {changes}")
-        time.sleep(5)
+        sleep(5)
 
     agent_1.stop()
     agent_2.stop()
 
 
+def simulate_global_optimizer(seed=0):
+    # Same experiment against the LGBN, the agents iterate whenever the simulation sleeps
+    simulation = Simulation("./LGBN.csv", seed)
+    agent_1, agent_2, glo = create_agents(**simulation.clients())
+
+    start_greedy_agents(agent_1, agent_2, simulation.reset_services, simulation.start_agent, simulation.sleep)
+    improve_global_slof(agent_1, agent_2, glo, simulation.sleep)
+    flush_experience()
+
+
 def visualize_data():
     df = pd.read_csv("./slo_f.csv")
     del df['timestamp']
@@ -104,6 +122,8 @@ def visualize_data():
 
 
 if __name__ == '__main__':
-    # start_greedy_agents()
-    # improve_global_slof()
+    # agents = create_agents()
+    # start_greedy_agents(*agents[:2])
+    # improve_global_slof(*agents)
+    # simulate_global_optimizer()
     visualize_data()
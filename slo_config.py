@@ -42,3 +42,12 @@ def calculate_slo_reward(state, slos=MB['slos']):
         fuzzy_slof.append(slo_f)
 
     return fuzzy_slof
+
+
+def calculate_slo_reward_batch(states: np.ndarray, slos=MB['slos']) -> np.ndarray:
+    # Same as calculate_slo_reward, but for a matrix with one state per row
+    t, neg, boost = (np.array(column, dtype=np.float64) for column in zip(*slos[:states.shape[1]]))
+    ratio = states / t
+
+    slo_f = np.where(neg.astype(bool), 1 - ratio, ratio)
+    return np.clip(slo_f, 0.0, 1.10) * boost
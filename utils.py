@@ -1,6 +1,12 @@
+import atexit
 import csv
+import datetime
+import glob
 import logging
+import math
 import os
+import queue
+import threading
 import time
 
 import cv2
@@ -61,39 +67,89 @@ def print_execution_time(func):
 
 
 class FPS_:
-    def __init__(self, max_fps=300, sliding_window=5):
-        self.prev_time = 0
-        self.new_time = 0
+    """Frame rate over sliding windows (in seconds) and as an exponentially weighted average, without a rate cap."""
 
-        self.time_store = Cyclical_Array(max_fps)
-        # self.fps_store = Cyclical_Array(sliding_window)
+    def __init__(self, windows=(1, 5), ewma_tau=2.0):
+        self.windows = {window: SlidingRate(window) for window in windows}
+        self.ewma = EwmaRate(ewma_tau)
+        self._lock = threading.Lock()
 
     def tick(self) -> None:
-        self.time_store.put(time.time())
+        now = time.monotonic()
+        with self._lock:
+            for rate in self.windows.values():
+                rate.tick(now)
+            self.ewma.tick(now)
 
     # @print_execution_time
     def get_current_fps(self) -> int:
-        current_time = time.time()
-        recent_timestamps = [t for t in self.time_store.data if current_time - t <= 1]
-        return len(recent_timestamps)
+        return int(round(self.get_fps(1)))
 
-    # def get_balanced_fps(self) -> int:
-    #     self.fps_store.put(self.get_current_fps())
-    #     return int(self.fps_store.get_average())
+    def get_fps(self, window) -> float:
+        with self._lock:
+            return self.windows[window].get_rate(time.monotonic())
 
+    def get_ewma_fps(self) -> float:
+        with self._lock:
+            return self.ewma.get_rate(time.monotonic())
 
-class Cyclical_Array:
-    def __init__(self, size):
-        self.data = np.zeros(size, dtype=object)
-        self.index = 0
-        self.size = size
 
-    def put(self, item):
-        self.data[self.index % self.size] = item
-        self.index = self.index + 1
+class SlidingRate:
+    """Event rate over a sliding window, counted in fixed-width buckets with a running total."""
 
-    def get_average(self):
-        return np.mean(self.data, dtype=np.float64)
+    def __init__(self, window, buckets=50):
+        self.window = window
+        self.bucket_width = window / buckets
+        self.counts = np.zeros(buckets, dtype=np.float64)
+        self.total = 0.0
+        self.current = None  # Absolute index of the bucket that receives new ticks
+
+    def _advance(self, now):
+        index = int(now / self.bucket_width)
+        if self.current is None:
+            self.current = index
+            return
+
+        steps = index - self.current
+        if steps >= len(self.counts):
+            self.counts[:] = 0.0
+            self.total = 0.0
+        else:
+            for step in range(1, steps + 1):
+                slot = (self.current + step) % len(self.counts)
+                self.total -= self.counts[slot]
+                self.counts[slot] = 0.0
+        self.current = max(index, self.current)
+
+    def tick(self, now, events=1):
+        self._advance(now)
+        self.counts[self.current % len(self.counts)] += events
+        self.total += events
+
+    def get_rate(self, now) -> float:
+        self._advance(now)
+        return self.total / self.window
+
+
+class EwmaRate:
+    """Exponentially decaying event rate with time constant tau (in seconds)."""
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.rate = 0.0
+        self.last_time = None
+
+    def _decayed(self, now):
+        if self.last_time is None:
+            return 0.0
+        return self.rate * math.exp(-(now - self.last_time) / self.tau)
+
+    def tick(self, now, events=1):
+        self.rate = self._decayed(now) + events / self.tau
+        self.last_time = now
+
+    def get_rate(self, now) -> float:
+        return self._decayed(now)
 
 
 def convert_prom_multi(raw_result, item_name="__name__", decimal=False):
@@ -109,34 +165,158 @@ def filter_tuple(t, name, index):
 
 
 
-@print_execution_time
-def write_metrics_to_csv(lines):
-    # Define the directory and file name
-    directory = "./share/metrics"
-    file_name = "LGBN.csv"
-    file_path = os.path.join(directory, file_name)
-
-    # Ensure the directory exists
-    # if not os.path.exists(directory):
-    #     os.makedirs(directory)
-
-    # Check if the file exists
-    file_exists = os.path.isfile(file_path)
-
-    # Open the file in append mode
-    with open(file_path, mode='a', newline='') as file:
-        writer = csv.writer(file)
-
-        if not file_exists or os.path.getsize(file_path) == 0:
-            writer.writerow(["timestamp", "fps", "pixel", "cores", "energy", "change_flag"])
+_FLUSH = object()
+ROTATION_FORMAT = "%Y%m%d%H%M%S%f"  # Fixed width, so rotated files sort by name in the order they were rotated
+
+
+class CsvMetricsWriter:
+    """Appends rows to a CSV file from a background thread through a bounded queue.
+
+    The file stays open; rows are flushed once flush_rows are pending or flush_interval seconds passed. If max_bytes
+    is set, a full file is renamed with a timestamp suffix and a new one with the header is started.
+    """
+
+    def __init__(self, file_path, header, max_queue=10000, flush_rows=15, flush_interval=5.0, max_bytes=None):
+        self.file_path = file_path
+        self.header = header
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._file = None
+        self._writer = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, row) -> bool:
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Metric queue for {self.file_path} is full, dropped {self.dropped} rows so far")
+            return False
+
+    def writerows(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        # Blocks until every row written so far is in the file
+        self._queue.put(_FLUSH)
+        self._queue.join()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join(timeout=self.flush_interval)
+
+    def _open(self):
+        self._file = open(self.file_path, mode='a', newline='')
+        self._writer = csv.writer(self._file)
+        if self._file.tell() == 0:
+            self._writer.writerow(self.header)
+
+    def _rotate(self):
+        self._file.close()
+        root, ext = os.path.splitext(self.file_path)
+        os.rename(self.file_path, f"{root}_{datetime.datetime.now().strftime(ROTATION_FORMAT)}{ext}")
+        self._open()
+
+    def _run(self):
+        pending = []
+        taken = 0  # Rows taken from the queue whose task_done is held back until they are written
+        last_flush = time.monotonic()
+        stopped = False
+
+        while not stopped:
+            forced = False
+            try:
+                row = self._queue.get(timeout=self.flush_interval)
+                taken += 1
+                if row is None:
+                    stopped = True
+                elif row is _FLUSH:
+                    forced = True
+                else:
+                    pending.append(row)
+            except queue.Empty:
+                pass
+
+            due = time.monotonic() - last_flush >= self.flush_interval
+            if pending and (len(pending) >= self.flush_rows or due or stopped or forced):
+                try:
+                    self._write_pending(pending)
+                except OSError as e:
+                    logger.error(f"Could not write metrics to {self.file_path}: {e}")
+                pending.clear()
+                last_flush = time.monotonic()
+
+            if not pending:
+                for _ in range(taken):
+                    self._queue.task_done()
+                taken = 0
+
+        if self._file is not None:
+            self._file.close()
+
+    def _write_pending(self, rows):
+        if self._file is None:
+            self._open()
+
+        self._writer.writerows(rows)
+        self._file.flush()
+
+        if self.max_bytes is not None and self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+
+def rotated_files(file_path, since=None) -> list[str]:
+    """Files a CsvMetricsWriter rotated away from file_path, oldest first, followed by file_path if it exists.
+
+    Rotated files are named by the time of their rotation, so those rotated before since hold no newer rows.
+    """
+    root, ext = os.path.splitext(file_path)
+    width = len(datetime.datetime.now().strftime(ROTATION_FORMAT))
+    files = []
+    for path in sorted(glob.glob(f"{glob.escape(root)}_{'[0-9]' * width}{ext}")):
+        rotated = datetime.datetime.strptime(path[len(root) + 1:len(path) - len(ext)], ROTATION_FORMAT)
+        if since is None or rotated >= since:
+            files.append(path)
+    if os.path.exists(file_path):
+        files.append(file_path)
+    return files
+
+
+_metrics_writers = {}
+_metrics_writers_lock = threading.Lock()
+
+# LGBN.csv grows by a row every 250ms for as long as a service runs; it is rotated once it reaches this size
+LGBN_MAX_BYTES = int(get_env_param('LGBN_MAX_BYTES', 64 * 1024 * 1024))
+
+
+def get_metrics_writer(file_path, header, **kwargs) -> CsvMetricsWriter:
+    if os.path.basename(file_path) == "LGBN.csv":
+        kwargs.setdefault("max_bytes", LGBN_MAX_BYTES)
+
+    with _metrics_writers_lock:
+        writer = _metrics_writers.get(file_path)
+        if writer is None:
+            writer = CsvMetricsWriter(file_path, header, **kwargs)
+            _metrics_writers[file_path] = writer
+        return writer
 
-        writer.writerows(lines)
 
 def calculate_cpu_percentage(stats):
 
     cpu_delta: int = stats['cpu_stats']['cpu_usage']['total_usage'] - stats['precpu_stats']['cpu_usage']['total_usage']
     system_delta: int = stats['cpu_stats']['system_cpu_usage'] - stats['precpu_stats']['system_cpu_usage']
-    number_of_cores: int = 16
+    number_of_cores: int = stats['cpu_stats'].get('online_cpus') or len(stats['cpu_stats']['cpu_usage']['percpu_usage'])
     cpu_percent: float = (cpu_delta / system_delta) * number_of_cores * 100
 
     return int(cpu_percent)
\ No newline at end of file